@@ -0,0 +1,66 @@
+#Compares the transcription encoding profiles against the original mp3 output.
+#Each input file is encoded with every profile in capture.ENCODING_PROFILES and transcribed, then the
+#upload size and the word error rate against the plain mp3 transcript are reported.
+#Run from src/ so config.json is found:  python ../bench/encoding_profiles.py recording1.wav recording2.wav
+import asyncio
+import os
+import re
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import apiClient
+import audioPrep
+import capture
+
+REFERENCE_PROFILE = 'mp3'
+
+def words(text):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+def word_error_rate(reference, hypothesis):
+    #Word-level Levenshtein distance divided by the reference length
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, start=1):
+        current = [i] + [0] * len(hypothesis)
+        for j, hyp_word in enumerate(hypothesis, start=1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word))
+        previous = current
+    return previous[-1] / max(len(reference), 1)
+
+async def encode(source, destination, profile):
+    returncode, output = await audioPrep.run_ffmpeg('-y', '-i', source, '-ac', '1', *profile['args'], destination)
+    if returncode != 0:
+        raise RuntimeError(f"Encoding {source} to {destination} failed: {output[-500:]}")
+
+async def benchmark_file(source, workdir):
+    results = {}
+    for name, profile in capture.ENCODING_PROFILES.items():
+        destination = os.path.join(workdir, f"{os.path.splitext(os.path.basename(source))[0]}_{name}{profile['ext']}")
+        await encode(source, destination, profile)
+        segments = await apiClient.request_transcription(destination, apiClient.BACKGROUND)
+        results[name] = {'bytes': os.path.getsize(destination), 'text': ' '.join(segment['text'] for segment in segments or [])}
+    reference = words(results[REFERENCE_PROFILE]['text'])
+    for result in results.values():
+        result['wer'] = word_error_rate(reference, words(result['text']))
+    return results
+
+async def main(sources):
+    totals = {name: {'bytes': 0, 'wer': 0.0} for name in capture.ENCODING_PROFILES}
+    with tempfile.TemporaryDirectory() as workdir:
+        for source in sources:
+            results = await benchmark_file(source, workdir)
+            print(source)
+            for name, result in results.items():
+                print(f"  {name:<10} {result['bytes'] / 1024:>10.1f} KiB  WER vs {REFERENCE_PROFILE}: {result['wer']:.3f}")
+                totals[name]['bytes'] += result['bytes']
+                totals[name]['wer'] += result['wer']
+    print("Overall")
+    for name, total in totals.items():
+        ratio = total['bytes'] / max(totals[REFERENCE_PROFILE]['bytes'], 1)
+        print(f"  {name:<10} {ratio:>6.1%} of {REFERENCE_PROFILE} size  mean WER {total['wer'] / len(sources):.3f}")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python ../bench/encoding_profiles.py <audio file> [<audio file> ...]")
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1:]))
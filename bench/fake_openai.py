@@ -0,0 +1,126 @@
+#Local stand-in for the OpenAI endpoints Glyph uses, for benchmarks and offline runs.
+#Transcriptions answer with verbose_json segments sized from the upload, chat completions with a short
+#canned summary. Latency and 429s are simulated so the scheduler's rate limiting and backoff get exercised.
+#  python ../bench/fake_openai.py --port 8765 --latency 0.8 --rate-limit 0.05
+#then set "openai_base_url": "http://127.0.0.1:8765/v1" in config.json, or let bench/pipeline.py start it.
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+from aiohttp import web
+
+#Roughly the byte rate of the opus transcription profile, used to guess how long an upload is
+UPLOAD_BYTES_PER_SECOND = 3000
+SEGMENT_SECONDS = 4.0
+WORDS = ['the', 'dragon', 'um', 'goblin', 'uh', 'tavern', 'roll', 'initiative', 'you know', 'sword', 'attack', 'like', 'spell', 'door', 'treasure']
+
+class FakeOpenAI:
+    def __init__(self, latency, latency_per_mb, jitter, rate_limit, max_concurrency, seed):
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.stats = {'transcriptions': 0, 'chat': 0, 'embeddings': 0, 'rate_limited': 0}
+
+    def throttled(self):
+        #Random 429s, plus a hard one whenever too many requests are in flight
+        return self.random.random() < self.rate_limit or (self.max_concurrency and self.in_flight >= self.max_concurrency)
+
+    def rate_limited_response(self):
+        self.stats['rate_limited'] += 1
+        body = {'error': {'message': 'Rate limit reached (simulated)', 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+        return web.json_response(body, status=429, headers={'retry-after': '1'})
+
+    async def delay(self, size_bytes):
+        seconds = self.latency + self.latency_per_mb * size_bytes / 1_000_000
+        await asyncio.sleep(max(0.0, seconds * (1 + self.random.uniform(-self.jitter, self.jitter))))
+
+    async def transcriptions(self, request):
+        if self.throttled():
+            return self.rate_limited_response()
+        self.in_flight += 1
+        try:
+            form = await request.post()
+            audio = form['file'].file.read()
+            await self.delay(len(audio))
+        finally:
+            self.in_flight -= 1
+        self.stats['transcriptions'] += 1
+        digest = hashlib.sha256(audio).digest()
+        duration = max(1.0, len(audio) / UPLOAD_BYTES_PER_SECOND)
+        segments = []
+        for index in range(max(1, int(duration // SEGMENT_SECONDS))):
+            words = [WORDS[(digest[(index + offset) % len(digest)] + offset) % len(WORDS)] for offset in range(6)]
+            segments.append({
+                'id': index, 'seek': 0, 'start': index * SEGMENT_SECONDS, 'end': (index + 1) * SEGMENT_SECONDS - 0.5,
+                'text': ' ' + ' '.join(words).capitalize() + '.', 'tokens': [], 'temperature': 0.0,
+                'avg_logprob': -0.2, 'compression_ratio': 1.2, 'no_speech_prob': 0.01
+            })
+        return web.json_response({'task': 'transcribe', 'language': 'english', 'duration': duration,
+                                  'text': ''.join(segment['text'] for segment in segments), 'segments': segments})
+
+    async def chat(self, request):
+        if self.throttled():
+            return self.rate_limited_response()
+        body = await request.json()
+        prompt = ''.join(message.get('content') or '' for message in body.get('messages', []))
+        self.in_flight += 1
+        try:
+            await self.delay(len(prompt))
+        finally:
+            self.in_flight -= 1
+        self.stats['chat'] += 1
+        prompt_tokens = len(prompt) // 4 + 1
+        content = f"Session notes (simulated) covering {prompt_tokens} prompt tokens.\n\n- The party talked.\n- Things happened."
+        return web.json_response({
+            'id': f'chatcmpl-fake-{self.stats["chat"]}', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4 + 1, 'total_tokens': prompt_tokens + len(content) // 4 + 1}
+        })
+
+    async def embeddings(self, request):
+        if self.throttled():
+            return self.rate_limited_response()
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        await self.delay(sum(len(text) for text in inputs))
+        self.stats['embeddings'] += 1
+        data = []
+        for index, text in enumerate(inputs):
+            digest = hashlib.sha256(text.encode()).digest()
+            data.append({'object': 'embedding', 'index': index, 'embedding': [byte / 255 - 0.5 for byte in digest[:16]]})
+        return web.json_response({'object': 'list', 'data': data, 'model': body.get('model', 'fake'),
+                                  'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+    async def stats_handler(self, request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/audio/transcriptions', self.transcriptions)
+        app.router.add_post('/v1/chat/completions', self.chat)
+        app.router.add_post('/v1/embeddings', self.embeddings)
+        app.router.add_get('/stats', self.stats_handler)
+        return app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake OpenAI server for Glyph benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help="base seconds per request")
+    parser.add_argument('--latency-per-mb', type=float, default=1.0, help="extra seconds per MB of upload or prompt")
+    parser.add_argument('--jitter', type=float, default=0.2, help="latency varies by up to this fraction either way")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="probability of answering 429")
+    parser.add_argument('--max-concurrency', type=int, default=0, help="answer 429 past this many requests in flight (0 for no limit)")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = FakeOpenAI(args.latency, args.latency_per_mb, args.jitter, args.rate_limit, args.max_concurrency, args.seed)
+    web.run_app(server.app(), host=args.host, port=args.port, print=lambda message: print(message, flush=True))
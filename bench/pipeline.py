@@ -0,0 +1,218 @@
+#End-to-end benchmark of record -> transcribe -> merge -> notes without Discord or OpenAI.
+#Synthetic speakers are fed packet by packet through Recorder.capture_packet, the same path the voice
+#receive callback uses, on one feeder thread per guild. Whisper and chat calls go to bench/fake_openai.py,
+#started as a separate process, so its simulated latency and 429s exercise the real scheduler.
+#Each guild then goes through what /done does: drain, encode the leftovers, transcribe, combine_transcripts, generate_notes.
+#Run from src/ so config.json is found (its openai_scheduler limits apply):
+#  python ../bench/pipeline.py --guilds 4 --speakers 5 --minutes 30 --latency 0.8 --rate-limit 0.05
+import argparse
+import array
+import asyncio
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+import asqlite
+import apiClient
+import capture
+import compaction
+import offload
+import database
+import metrics
+import cogs.recorder as recorder_module
+from cogs.recorder import Recorder, RecordingSession, combine_transcripts
+from rollingSummary import RollingSummarizer
+from rosterCache import RosterCache
+from sessionJournal import SessionJournal
+from transcriptionBackends import create_backend
+
+PACKET_SECONDS = 0.02
+PACKET_SAMPLES = int(capture.INPUT_RATE * PACKET_SECONDS)
+
+class BenchUser:
+    #Stands in for discord.Member, which the recorder uses as a dict key and reads id and name from
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+
+def speaker_packets(index, count=50):
+    #A few stereo packets of an amplitude-modulated tone, distinct per speaker, loud enough to pass VAD
+    frequency = 140 + 35 * index
+    packets = []
+    for packet in range(count):
+        samples = array.array('h')
+        for sample in range(PACKET_SAMPLES):
+            t = (packet * PACKET_SAMPLES + sample) / capture.INPUT_RATE
+            value = int(9000 * (0.6 + 0.4 * math.sin(2 * math.pi * 3 * t)) * math.sin(2 * math.pi * frequency * t))
+            samples.extend((value, value))
+        packets.append(SimpleNamespace(pcm=samples.tobytes()))
+    return packets
+
+def conversation(speakers, seconds, rng):
+    #Turns of (speaker index, start, length): one speaker at a time with short pauses, like a table talking
+    turns = []
+    position = 0.0
+    while position < seconds:
+        length = min(rng.uniform(2, 12), seconds - position)
+        turns.append((rng.randrange(speakers), position, length))
+        position += length + rng.uniform(0.3, 2.5)
+    return turns
+
+def feed(recorder, session, users, packets, turns, start, pace):
+    #Runs on its own thread, like discord-ext-voice-recv's reader. Time is virtual: `start` plus the audio
+    #position, and with pace > 0 packets are also held back to that many times real time.
+    began = time.perf_counter()
+    count = 0
+    for speaker, turn_start, length in turns:
+        for packet in range(int(length / PACKET_SECONDS)):
+            position = turn_start + packet * PACKET_SECONDS
+            if pace:
+                ahead = position / pace - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+            recorder.capture_packet(session, users[speaker], packets[speaker][count % len(packets[speaker])], start + position)
+            count += 1
+    return count
+
+def percentiles(values):
+    if not values:
+        return 'n=0'
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return f"n={len(ordered)} p50={pick(0.5):.3f}s p95={pick(0.95):.3f}s p99={pick(0.99):.3f}s max={ordered[-1]:.3f}s"
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def start_fake_openai(args):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'fake_openai.py'), '--port', str(port),
+        '--latency', str(args.latency), '--latency-per-mb', str(args.latency_per_mb),
+        '--rate-limit', str(args.rate_limit), '--max-concurrency', str(args.max_concurrency), '--seed', str(args.seed)
+    ], stdout=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, f'http://127.0.0.1:{port}/v1'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Fake OpenAI server did not start")
+
+async def run_guild(recorder, bot, guild_id, args, timings):
+    rng = random.Random(args.seed + guild_id)
+    campaign_id = guild_id
+    users = [BenchUser(guild_id * 100 + index, f'g{guild_id}speaker{index}') for index in range(args.speakers)]
+    bot.roster.add_campaign(campaign_id, f'Bench campaign {guild_id}', users[0].id, guild_id)
+    for user in users[1:]:
+        bot.roster.add_player(campaign_id, user.id, f'Character {user.id}')
+    async with bot.db.acquire() as conn:
+        await conn.execute("INSERT INTO campaigns (campaign_id, campaign_name, gm_id, guild_id) VALUES (?, ?, ?, ?)",
+                           (campaign_id, f'Bench campaign {guild_id}', users[0].id, guild_id))
+        await conn.commit()
+
+    session = RecordingSession(guild_id, None, {'campaign_id': campaign_id, 'campaign_name': f'Bench campaign {guild_id}', 'total_sessions': 0}, bot.journal)
+    if apiClient.config.get('rolling_summary', True):
+        session.summarizer = RollingSummarizer(bot.roster.name_ref(campaign_id))
+    session.start_recording()
+    start = session.session_start
+    await bot.journal.open_session(session)
+
+    packets = [speaker_packets(index) for index in range(args.speakers)]
+    turns = conversation(args.speakers, args.minutes * 60, rng)
+    began = time.perf_counter()
+    sent = await asyncio.to_thread(feed, recorder, session, users, packets, turns, start, args.pace)
+    timings['capture'].append(time.perf_counter() - began)
+
+    #The same steps as /done
+    began = time.perf_counter()
+    buffers = session.stop_recording()
+    await recorder.drain_session(session)
+    await apiClient.transcribe_files(await recorder.encode_buffers(session, buffers), session)
+    timings['finish transcription'].append(time.perf_counter() - began)
+
+    began = time.perf_counter()
+    segment_count = await combine_transcripts(session=session, bot=bot)
+    timings['combine'].append(time.perf_counter() - began)
+
+    began = time.perf_counter()
+    notes = await apiClient.generate_notes(session=session)
+    timings['notes'].append(time.perf_counter() - began)
+    return {'packets': sent, 'segments': segment_count, 'notes': isinstance(notes, str)}
+
+async def main(args):
+    await offload.run_io(compaction.load_tokenizer)
+    process, base_url = start_fake_openai(args)
+    workdir = tempfile.mkdtemp(prefix='glyph-bench-')
+    #Chunks, transcripts, notes and the Whisper cache all land in the scratch directory
+    os.chdir(workdir)
+    try:
+        apiClient.client.base_url = base_url
+        apiClient.transcription_backend = create_backend({'type': args.backend, 'latency': args.latency}, apiClient.client, apiClient.scheduler, apiClient.WHISPER_PARAMS)
+        recorder_module.MAX_CHUNK_SECONDS = args.chunk_seconds
+        async with asqlite.create_pool('bench.db', size=5, init=database.configure_connection) as pool:
+            async with pool.acquire() as conn:
+                await database.migrate(conn)
+            bot = SimpleNamespace(loop=asyncio.get_running_loop(), db=pool, roster=RosterCache(), journal=SessionJournal(pool), sessions={})
+            recorder = Recorder(bot)
+            recorder.transcription_queue.start()
+            timings = {'capture': [], 'finish transcription': [], 'combine': [], 'notes': []}
+            began = time.perf_counter()
+            results = await asyncio.gather(*(run_guild(recorder, bot, guild_id, args, timings) for guild_id in range(1, args.guilds + 1)))
+            elapsed = time.perf_counter() - began
+            await recorder.transcription_queue.stop()
+    finally:
+        process.terminate()
+        process.wait()
+
+    audio_seconds = args.guilds * args.minutes * 60
+    packets = sum(result['packets'] for result in results)
+    print(f"{args.guilds} guilds x {args.speakers} speakers x {args.minutes} min, backend {args.backend}, workdir {workdir}")
+    print(f"Wall time {elapsed:.1f}s, {audio_seconds / elapsed:.1f} session-seconds per second, {packets / elapsed:.0f} packets per second")
+    print(f"Segments merged {sum(result['segments'] or 0 for result in results)}, notes written for {sum(result['notes'] for result in results)}/{args.guilds} guilds")
+    print("Per guild stage time")
+    for stage, values in timings.items():
+        print(f"  {stage:<22} {percentiles(values)}")
+    print("Pipeline metrics")
+    for metric in (metrics.encode_seconds, metrics.transcription_seconds, metrics.openai_wait_seconds, metrics.openai_seconds,
+                   metrics.persist_seconds, metrics.combine_seconds, metrics.notes_seconds):
+        for key, (count, total, _) in sorted(metric.snapshot().items()):
+            quantiles = ' '.join(f"p{round(q * 100)}={metric.quantile(q, key):.3f}s" for q in (0.5, 0.95, 0.99))
+            print(f"  {metric.name}{metrics.format_labels(metric.labels, key)} n={count} {quantiles}")
+    upload_bytes = sum(total for _, total, _ in metrics.upload_bytes.snapshot().values())
+    tokens = {key[0]: value for key, value in metrics.transcript_tokens.values.items()}
+    print(f"  transcript tokens merged {tokens.get('merged', 0)}, compacted {tokens.get('compacted', 0)}, sent for notes {tokens.get('prompt', 0)}")
+    print(f"  uploaded {upload_bytes / 1024 / 1024:.1f} MiB, {metrics.openai_retries.total()} retries, {metrics.rotations.total()} rotations")
+    #ru_maxrss is in KiB on Linux; children covers the ffmpeg encoders and the fake server
+    print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB, "
+          f"largest child process {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MiB")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Glyph record -> transcribe -> notes pipeline benchmark")
+    parser.add_argument('--guilds', type=int, default=2)
+    parser.add_argument('--speakers', type=int, default=4)
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--chunk-seconds', type=float, default=recorder_module.MAX_CHUNK_SECONDS, help="rotation limit, shorter means more chunks")
+    parser.add_argument('--pace', type=float, default=0, help="feed at this many times real time (0 for as fast as possible)")
+    parser.add_argument('--backend', choices=['openai', 'fake'], default='openai', help="openai talks to the fake server, fake skips HTTP")
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--latency-per-mb', type=float, default=1.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0)
+    parser.add_argument('--max-concurrency', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -2,6 +2,17 @@ import json
 import os
 import aiofiles
 import asyncio
+import segmentStore
+import audioPrep
+import capture
+import sessionJournal
+import metrics
+import offload
+import compaction
+import time
+from openaiScheduler import OpenAIScheduler, LIVE, NOTES, BACKGROUND
+from whisperCache import WhisperCache
+from transcriptionBackends import create_backend, SEGMENT_SCORES
 from datetime import timedelta
 from openai import AsyncOpenAI
 with open('config.json', 'r') as config_file:
@@ -9,8 +20,41 @@ with open('config.json', 'r') as config_file:
 
 
 TERMS = ['DnD','Roll20','Glyph','AC','HP']
-client = AsyncOpenAI(api_key=config['openai_key'])
-file_lock = asyncio.Lock()
+#Retries are handled by the scheduler, which all Whisper and chat requests go through
+client = AsyncOpenAI(api_key=config['openai_key'], base_url=config.get('openai_base_url'), max_retries=0)
+scheduler = OpenAIScheduler(config.get('openai_scheduler', {}))
+offload.configure(config.get('offload', {}))
+WHISPER_PARAMS = {
+    'model': "whisper-1",
+    'prompt': "Umm, let me think like, hmm... Okay, here's what I'm, like, thinking. Roll a D20, yeah, and see what you get.",
+    'response_format': "verbose_json",
+    'language': "en"
+}
+#Silence is cut out locally before upload, see audioPrep.prepare_for_upload
+VAD_SETTINGS = {
+    'enabled': True,
+    'noise_db': -35,
+    'min_silence': 1.0,
+    'padding': 0.25,
+    'max_speech_ratio': 0.9,
+    **config.get('vad', {})
+}
+#Where audio is transcribed, see transcriptionBackends.create_backend
+transcription_backend = create_backend(config.get('transcription_backend', {}), client, scheduler, WHISPER_PARAMS)
+TRANSCRIPTION_FORMAT = config.get('transcription_format', 'opus')
+#Chunks shorter than BATCH_MAX_CHUNK_SECONDS from one speaker are joined into a single upload of up to
+#BATCH_MAX_SECONDS, with BATCH_GAP_SECONDS of silence between them
+BATCH_MAX_CHUNK_SECONDS = config.get('batch_max_chunk_seconds', 60)
+BATCH_MAX_SECONDS = config.get('batch_max_seconds', 600)
+BATCH_GAP_SECONDS = config.get('batch_gap_seconds', 2)
+whisper_cache = WhisperCache(config.get('whisper_cache_dir', 'cache/whisper'), config.get('whisper_cache_max_mb', 512) * 1024 * 1024)
+#Long transcripts are summarized in parts of at most NOTES_CHUNK_TOKENS. How many requests run at once is up to
+#the scheduler's lanes, which let LIVE work ahead of NOTES and BACKGROUND.
+NOTES_MODEL = config.get('notes_model', 'gpt-4o')
+NOTES_CHUNK_TOKENS = config.get('notes_chunk_tokens', 12000)
+#Compacted transcripts over this many tokens lose their acknowledgement lines before summarizing, see compaction.fit_to_budget
+NOTES_TOKEN_BUDGET = config.get('notes_token_budget')
+compaction.configure(config.get('compaction', {}), NOTES_MODEL, [WHISPER_PARAMS['prompt']])
 
 def seconds_to_hhmm(seconds):
     elapsed_time = timedelta(seconds=seconds)
@@ -18,30 +62,96 @@ def seconds_to_hhmm(seconds):
     minutes = remainder // 60
     return f"{hours:02}:{minutes:02}"
 
-async def generate_notes(session=None, guild_id=None, campaign_id=None, session_number=None, user_id=None, note_type='summary',character=None):
-    print("Generating notes!")
+def note_prompt(note_type='summary', character=None):
     noteRef = {'summary':"You are reviewing audio transcripts from a Dungeons and Dragons session for the purpose of summarizing events and highlighting key or memorable moments. You are also recording these notes to help the party keep track of storylines/quests, people they meet and who they are, etc.",
                'character':f"You are reviewing audio transcripts from a Dungeons and Dragons session for the purpose of summarizing events and highlighting key or memorable moments for {character}. Any important actions, results, events, conversations, or similar useful information should be noted."
                }
+    return noteRef[note_type]
+
+def estimate_tokens(text):
+    return compaction.count_tokens(text)
+
+def split_by_tokens(pieces, max_tokens):
+    #Groups consecutive pieces (transcript lines or partial notes) so each group stays under max_tokens
+    groups = []
+    current = []
+    size = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and size + tokens > max_tokens:
+            groups.append(current)
+            current = []
+            size = 0
+        current.append(piece)
+        size += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+async def complete_notes(system_prompt, content, priority=NOTES):
+    response = await scheduler.run('chat', lambda: client.chat.completions.create(
+        model=NOTES_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{content}"}
+        ]
+    ), priority)
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        metrics.chat_tokens.inc(usage.prompt_tokens, kind='prompt')
+        metrics.chat_tokens.inc(usage.completion_tokens, kind='completion')
+    notes = response.choices[0].message.content
+    if notes is None:
+        raise ValueError("Chat completion returned no content")
+    return notes
+
+async def summarize_transcript(content, note_type='summary', character=None):
+    #Short transcripts go out in one request. Longer ones are split on line (segment) boundaries,
+    #each part is summarized concurrently, then the partial notes are folded together in order.
+    system_prompt = note_prompt(note_type, character)
+    parts = await offload.run_io(split_by_tokens, content.splitlines(keepends=True), NOTES_CHUNK_TOKENS)
+    if len(parts) <= 1:
+        return await complete_notes(system_prompt, content)
+
+    print(f"Transcript split into {len(parts)} parts")
+    partials = await asyncio.gather(*(
+        complete_notes(f"{system_prompt} This is part {index} of {len(parts)} of the session transcript. Write detailed notes for this part only.", ''.join(part))
+        for index, part in enumerate(parts, start=1)
+    ))
+    reduce_prompt = f"{system_prompt} You are given notes written from consecutive parts of the same session, in order. Combine them into one complete set of notes for the session."
+    while len(partials) > 1:
+        groups = await offload.run_io(split_by_tokens, partials, NOTES_CHUNK_TOKENS)
+        if len(groups) == len(partials):
+            groups = [partials]
+        partials = await asyncio.gather(*(
+            complete_notes(reduce_prompt, '\n\n'.join(f"Part {index} notes:\n{notes}" for index, notes in enumerate(group, start=1)))
+            for group in groups
+        ))
+    return partials[0]
+
+async def generate_notes(session=None, guild_id=None, campaign_id=None, session_number=None, user_id=None, note_type='summary',character=None):
+    print("Generating notes!")
+    started = time.perf_counter()
     try:
         if session is not None:
             print("Session found")
             guild_id = getattr(session, 'guild_id', guild_id)
             campaign_id = getattr(session, 'campaign_id', campaign_id)
             session_number = getattr(session, 'session_number', session_number)
-        #Get the recorded transcript
-        textFile = f'notes/{guild_id}_{campaign_id}_{session_number}_transcript.txt'
-        print(f"Working with textfile {textFile}")
-        async with aiofiles.open(textFile, 'r') as file:
-            content = await file.read()
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": noteRef[note_type]},
-                {"role": "user", "content": f"{content}"}
-            ]
-        )
-        notes = response.choices[0].message.content
+        notes = None
+        #Live sessions keep running notes, so only the last few minutes need folding in
+        summarizer = getattr(session, 'summarizer', None)
+        if note_type == 'summary' and summarizer is not None:
+            notes = await summarizer.finish()
+        if notes is None:
+            #Get the recorded transcript
+            textFile = f'notes/{guild_id}_{campaign_id}_{session_number}_transcript.txt'
+            print(f"Working with textfile {textFile}")
+            async with aiofiles.open(textFile, 'r') as file:
+                content = await file.read()
+            content, tokens = await offload.run_io(compaction.fit_to_budget, content, NOTES_TOKEN_BUDGET)
+            metrics.transcript_tokens.inc(tokens, stage='prompt')
+            notes = await summarize_transcript(content, note_type, character)
         print("Content returned")
         if notes is None:
             print("Notes empty!")
@@ -50,67 +160,193 @@ async def generate_notes(session=None, guild_id=None, campaign_id=None, session_
 
         async with aiofiles.open(f'notes/{guild_id}_{campaign_id}_{session_number}_summary.txt', 'w') as file:
             await file.write(notes)
+        journal = getattr(session, 'journal', None)
+        if journal is not None:
+            await journal.advance(session, sessionJournal.SUMMARIZED)
+        metrics.notes_seconds.observe(time.perf_counter() - started)
         return notes
 
 
     except Exception as e:
-        print(f"Error during transcription: {e}")
+        print(f"Error during note generation: {e}")
         return None
 
 
-async def transcribe_file(file_path,userID,session,fileStart):
+def plan_batches(user_files):
+    #Splits one user's files, in start order, into upload batches: short files are grouped, long ones go alone
+    batches = []
+    current = []
+    current_seconds = 0
+    for each in user_files:
+        duration = each.get('duration')
+        if duration is None or duration >= BATCH_MAX_CHUNK_SECONDS:
+            if current:
+                batches.append(current)
+                current, current_seconds = [], 0
+            batches.append([each])
+            continue
+        if current and current_seconds + duration + BATCH_GAP_SECONDS > BATCH_MAX_SECONDS:
+            batches.append(current)
+            current, current_seconds = [], 0
+        current.append(each)
+        current_seconds += duration + BATCH_GAP_SECONDS
+    if current:
+        batches.append(current)
+    return batches
+
+async def transcribe_files(files, session, priority=LIVE):
+    #Transcribes a batch of {'file','userID','start'} entries, with an optional 'duration' in seconds.
+    #Each user's files run in start order so their segments are appended in order, different users run concurrently.
+    by_user = {}
+    for each in files:
+        by_user.setdefault(str(each['userID']), []).append(each)
+
+    async def transcribe_user_files(user_files):
+        results = []
+        present = []
+        for each in sorted(user_files, key=lambda f: f['start']):
+            if await offload.exists(each['file']):
+                present.append(each)
+            else:
+                results.append({**each, 'status': 'missing', 'segments': None})
+        for batch in plan_batches(present):
+            if len(batch) == 1:
+                segments = await transcribe_file(batch[0]['file'], batch[0]['userID'], session, batch[0]['start'], priority)
+                results.append({**batch[0], 'status': 'failed' if segments is None else 'transcribed', 'segments': segments})
+            else:
+                results.extend(await transcribe_batch(batch, session, priority))
+        return results
+
+    grouped = await asyncio.gather(*(transcribe_user_files(user_files) for user_files in by_user.values()))
+    results = [result for user_results in grouped for result in user_results]
+    for result in results:
+        print(f"Transcription {result['status']} for {result['file']}")
+        metrics.transcription_results.inc(status=result['status'])
+    return results
+
+
+async def transcribe_file(file_path,userID,session,fileStart,priority=LIVE):
     print(f"Transcribing {file_path}")
     userID = str(userID)
     try:
-        #Ensure the transcripts directory exists
-        transcripts_dir = 'transcripts'
-        if not os.path.exists(transcripts_dir):
-            os.makedirs(transcripts_dir)
-        #Get the path for this session's transcripts
-        #Transcript structure is guildID_campaignID_sessionID.json
-        session_transcript_filename = f'transcripts/{session.guild_id}_{session.campaign_id}_{session.session_number}.json'
-        #Load existing transcriptions or initialize a new structure
-        async with file_lock:
-            if os.path.exists(session_transcript_filename):
-                async with aiofiles.open(session_transcript_filename, "r") as json_file:
-                    file_content = await json_file.read()
-                    all_transcripts = json.loads(file_content)
+        return await _transcribe_file(file_path,userID,session,fileStart,priority)
+    except Exception as e:
+        print(f"Error during transcription: {e}")
+        return None
+
+
+async def transcribe_batch(batch, session, priority=LIVE):
+    #Sends several short chunks from one user as a single upload and splits the segments back onto each chunk
+    print(f"Transcribing {len(batch)} short chunks together")
+    userID = str(batch[0]['userID'])
+    results = []
+    pending = []
+    try:
+        for each in batch:
+            cache_key = await transcription_cache_key(each['file'])
+            segments = await whisper_cache.get(cache_key)
+            if segments is None:
+                pending.append((each, cache_key))
             else:
-                all_transcripts = {}
-
-            with open(file_path, "rb") as audio_file:
-                transcript = await client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    prompt="Umm, let me think like, hmm... Okay, here's what I'm, like, thinking. Roll a D20, yeah, and see what you get.",
-                    response_format="verbose_json",
-                    language="en"
-                )
-            
-            if transcript is not None:
-                # Append the transcription results to the user's data in the global file
-                if userID not in all_transcripts:
-                    all_transcripts[userID] = []
-                print(transcript)
-                segData = [
-                    {
-                        'start_seconds': round(segment['start'] + (fileStart - session.session_start),2),  # Raw start time in seconds for sorting
-                        'end_seconds': round(segment['end'] + (fileStart - session.session_start),2),      # Raw end time in seconds for sorting
-                        'text': segment['text']
-                    }
-                    for segment in transcript.segments
-                ]
-                print(segData)
-                all_transcripts[userID].append(segData)
-                
-                # Save the updated transcriptions back to the single JSON file
-                async with aiofiles.open(session_transcript_filename, "w") as json_file:
-                    json_string = json.dumps(all_transcripts, indent=4)
-                    await json_file.write(json_string)
-                
-                print(f"Transcription complete for {file_path}, saved to {session_transcript_filename}")
+                results.append({**each, 'status': 'transcribed', 'segments': await persist_segments(segments, each['file'], userID, session, each['start'])})
+        if pending:
+            base_name, _ = os.path.splitext(pending[0][0]['file'])
+            joined_path = f"{base_name}_batch{capture.ENCODING_PROFILES[TRANSCRIPTION_FORMAT]['ext']}"
+            try:
+                layout = await audioPrep.concat_with_gaps([(each['file'], each['duration']) for each, _ in pending], joined_path, BATCH_GAP_SECONDS, capture.ENCODING_PROFILES[TRANSCRIPTION_FORMAT]['args'])
+                segments = await transcribe_speech(joined_path, priority)
+            finally:
+                await offload.remove(joined_path)
+            if segments is None:
+                results.extend({**each, 'status': 'failed', 'segments': None} for each, _ in pending)
             else:
-                print(f"Failed to transcribe {file_path}")
+                for (each, cache_key), chunk_segments in zip(pending, audioPrep.split_segments(segments, layout)):
+                    await whisper_cache.put(cache_key, chunk_segments)
+                    results.append({**each, 'status': 'transcribed', 'segments': await persist_segments(chunk_segments, each['file'], userID, session, each['start'])})
     except Exception as e:
-        print(f"Error during transcription: {e}")
-        return None
\ No newline at end of file
+        #Fall back to one request per chunk
+        print(f"Batched transcription failed, sending chunks one at a time: {e}")
+        finished = {result['file'] for result in results}
+        for each, _ in pending:
+            if each['file'] in finished:
+                continue
+            segments = await transcribe_file(each['file'], userID, session, each['start'], priority)
+            results.append({**each, 'status': 'failed' if segments is None else 'transcribed', 'segments': segments})
+    return sorted(results, key=lambda result: result['start'])
+
+
+async def request_transcription(file_path, priority=LIVE):
+    metrics.upload_bytes.observe(await offload.getsize(file_path), backend=transcription_backend.name)
+    with metrics.transcription_seconds.time(backend=transcription_backend.name):
+        return await transcription_backend.transcribe(file_path, priority)
+
+async def transcribe_speech(file_path, priority=LIVE):
+    #Uploads only the speech in the file and returns segments timed against the original file
+    if not VAD_SETTINGS['enabled']:
+        return await request_transcription(file_path, priority)
+    try:
+        upload_path, offset_map = await audioPrep.prepare_for_upload(file_path, VAD_SETTINGS, capture.ENCODING_PROFILES[TRANSCRIPTION_FORMAT]['args'])
+    except Exception as e:
+        print(f"Voice activity detection failed, uploading {file_path} untrimmed: {e}")
+        return await request_transcription(file_path, priority)
+    if upload_path is None:
+        print(f"No speech found in {file_path}, skipping upload")
+        return []
+    try:
+        segments = await request_transcription(upload_path, priority)
+    finally:
+        if upload_path != file_path:
+            await offload.remove(upload_path)
+    if segments is None:
+        return None
+    return [
+        {**segment, 'start': offset_map.to_original(segment['start']), 'end': offset_map.to_original(segment['end'])}
+        for segment in segments
+    ]
+
+async def transcription_cache_key(file_path):
+    #Hashing reads the whole file, so it runs on the offload thread pool
+    return await offload.run_io(whisper_cache.key_for, file_path, {**transcription_backend.cache_params(), 'vad': VAD_SETTINGS})
+
+async def _transcribe_file(file_path,userID,session,fileStart,priority=LIVE):
+    #Identical audio with identical request parameters is served from the local cache
+    cache_key = await transcription_cache_key(file_path)
+    segments = await whisper_cache.get(cache_key)
+    if segments is not None:
+        print(f"Cache hit for {file_path}")
+    else:
+        segments = await transcribe_speech(file_path, priority)
+        if segments is None:
+            print(f"Failed to transcribe {file_path}")
+            return None
+        await whisper_cache.put(cache_key, segments)
+    return await persist_segments(segments, file_path, userID, session, fileStart)
+
+async def persist_segments(segments, file_path, userID, session, fileStart):
+    #Moves chunk-relative segments onto the session timeline and appends them to the user's log
+    segData = [
+        {
+            'start_seconds': round(segment['start'] + (fileStart - session.session_start),2),  # Raw start time in seconds for sorting
+            'end_seconds': round(segment['end'] + (fileStart - session.session_start),2),      # Raw end time in seconds for sorting
+            'text': segment['text'],
+            #Whisper's confidence, kept so compaction can tell hallucinations on silence from speech
+            **{name: segment[name] for name in SEGMENT_SCORES if name in segment}
+        }
+        for segment in segments
+    ]
+    print(segData)
+    # Append this chunk to the user's segment log for the session, keyed by the chunk's start time
+    with metrics.persist_seconds.time():
+        appended = await segmentStore.append_chunk(session.guild_id, session.campaign_id, session.session_number, userID, fileStart, segData)
+    journal = getattr(session, 'journal', None)
+    if journal is not None:
+        await journal.chunk_transcribed(session, file_path)
+    if not appended:
+        print(f"{file_path} was already transcribed for this session")
+        return segData
+    summarizer = getattr(session, 'summarizer', None)
+    if summarizer is not None:
+        summarizer.add_segments(userID, segData)
+    
+    print(f"Transcription complete for {file_path}, saved to {segmentStore.session_dir(session.guild_id, session.campaign_id, session.session_number)}")
+    return segData
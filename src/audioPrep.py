@@ -0,0 +1,132 @@
+import asyncio
+import bisect
+import os
+import re
+
+SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+SILENCE_END = re.compile(r'silence_end: (-?[\d.]+)')
+DURATION = re.compile(r'Duration: (\d+):(\d+):([\d.]+)')
+
+class OffsetMap:
+    #Maps times in a trimmed file back onto the original file's timeline.
+    #Each region is (trimmed_start, original_start, length), in trimmed order.
+    def __init__(self, regions):
+        self.regions = regions
+        self.starts = [trimmed_start for trimmed_start, _, _ in regions]
+
+    @classmethod
+    def identity(cls, duration):
+        return cls([(0.0, 0.0, duration)])
+
+    def to_original(self, seconds):
+        if not self.regions:
+            return seconds
+        index = max(bisect.bisect_right(self.starts, seconds) - 1, 0)
+        trimmed_start, original_start, length = self.regions[index]
+        return original_start + min(max(seconds - trimmed_start, 0.0), length)
+
+async def run_ffmpeg(*args):
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-nostats', *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    return process.returncode, stderr.decode(errors='replace')
+
+async def detect_speech(file_path, noise_db=-35, min_silence=1.0, padding=0.25):
+    #Runs ffmpeg's silencedetect over the file and returns the padded speech regions and the file duration
+    returncode, output = await run_ffmpeg('-i', file_path, '-af', f'silencedetect=noise={noise_db}dB:d={min_silence}', '-f', 'null', '-')
+    duration_match = DURATION.search(output)
+    if returncode != 0 or duration_match is None:
+        raise RuntimeError(f"silencedetect failed for {file_path}")
+    hours, minutes, seconds = duration_match.groups()
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    silences = []
+    silence_start = None
+    for line in output.splitlines():
+        start_match = SILENCE_START.search(line)
+        if start_match:
+            silence_start = max(float(start_match.group(1)), 0.0)
+            continue
+        end_match = SILENCE_END.search(line)
+        if end_match and silence_start is not None:
+            silences.append((silence_start, float(end_match.group(1))))
+            silence_start = None
+    if silence_start is not None:
+        silences.append((silence_start, duration))
+
+    speech = []
+    cursor = 0.0
+    for silence_start, silence_end in silences + [(duration, duration)]:
+        if silence_start > cursor:
+            start = max(cursor - padding, 0.0)
+            end = min(silence_start + padding, duration)
+            if speech and start <= speech[-1][1]:
+                speech[-1] = (speech[-1][0], end)
+            else:
+                speech.append((start, end))
+        cursor = max(cursor, silence_end)
+    return speech, duration
+
+async def trim_to_speech(file_path, output_path, speech, output_args=()):
+    #Writes only the speech regions of file_path, back to back, and returns the offset map for the result
+    selection = '+'.join(f'between(t,{start:.3f},{end:.3f})' for start, end in speech)
+    returncode, output = await run_ffmpeg('-y', '-i', file_path, '-af', f"aselect='{selection}',asetpts=N/SR/TB", *output_args, output_path)
+    if returncode != 0:
+        raise RuntimeError(f"Trimming {file_path} failed: {output[-500:]}")
+    regions = []
+    trimmed_start = 0.0
+    for start, end in speech:
+        regions.append((trimmed_start, start, end - start))
+        trimmed_start += end - start
+    return OffsetMap(regions)
+
+async def prepare_for_upload(file_path, settings, output_args=()):
+    #Returns (path to upload, offset map), or (None, None) if the file holds no speech.
+    #Files that are mostly speech already are uploaded as they are.
+    speech, duration = await detect_speech(file_path, settings['noise_db'], settings['min_silence'], settings['padding'])
+    if not speech:
+        return None, None
+    speech_seconds = sum(end - start for start, end in speech)
+    if speech_seconds >= duration * settings['max_speech_ratio']:
+        return file_path, OffsetMap.identity(duration)
+    base_name, ext = os.path.splitext(file_path)
+    trimmed_path = f'{base_name}_speech{ext}'
+    offset_map = await trim_to_speech(file_path, trimmed_path, speech, output_args)
+    print(f"Trimmed {file_path} from {round(duration)}s to {round(speech_seconds)}s of speech")
+    return trimmed_path, offset_map
+
+async def concat_with_gaps(chunks, output_path, gap, output_args=()):
+    #Joins (path, duration) chunks into one file with `gap` seconds of silence after each.
+    #Every chunk is trimmed or padded to exactly duration + gap, so the returned (start, duration) layout is exact.
+    args = ['-y']
+    for path, _ in chunks:
+        args += ['-i', path]
+    filters = []
+    layout = []
+    position = 0.0
+    for index, (path, duration) in enumerate(chunks):
+        filters.append(f'[{index}:a]aresample=16000,aformat=channel_layouts=mono,atrim=0:{duration:.3f},apad=whole_dur={duration + gap:.3f}[a{index}]')
+        layout.append((position, duration))
+        position += duration + gap
+    filters.append(''.join(f'[a{index}]' for index in range(len(chunks))) + f'concat=n={len(chunks)}:v=0:a=1[out]')
+    returncode, output = await run_ffmpeg(*args, '-filter_complex', ';'.join(filters), '-map', '[out]', *output_args, output_path)
+    if returncode != 0:
+        raise RuntimeError(f"Joining {len(chunks)} chunks failed: {output[-500:]}")
+    return layout
+
+def split_segments(segments, layout):
+    #Hands segments from a joined file back to the chunk each one starts in, timed against that chunk
+    starts = [start for start, _ in layout]
+    per_chunk = [[] for _ in layout]
+    for segment in segments:
+        index = max(bisect.bisect_right(starts, segment['start']) - 1, 0)
+        start, duration = layout[index]
+        per_chunk[index].append({
+            **segment,
+            'start': min(max(segment['start'] - start, 0.0), duration),
+            'end': min(max(segment['end'] - start, 0.0), duration)
+        })
+    return per_chunk
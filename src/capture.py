@@ -0,0 +1,107 @@
+import array
+import asyncio
+import metrics
+import offload
+
+#Discord hands over 48kHz stereo s16le PCM. Buffers keep one channel at 16kHz, which is all Whisper uses,
+#so a buffered chunk takes a third of the memory it would at the input rate.
+INPUT_RATE = 48000
+INPUT_CHANNELS = 2
+SAMPLE_RATE = 16000
+DOWNSAMPLE = INPUT_RATE // SAMPLE_RATE
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+#Packets arriving within this many seconds of the end of the current run extend it, anything later starts a new run
+RUN_GAP_SECONDS = 0.1
+SILENCE_BLOCK = bytes(BYTES_PER_SECOND)
+
+#Output settings for transcription input, picked with config 'transcription_format'.
+#Capture is already 16kHz mono, which is what Whisper works on, so the opus profile loses nothing it would use and is
+#a fraction of the mp3 size.
+ENCODING_PROFILES = {
+    'mp3': {'ext': '.mp3', 'args': []},
+    'mp3_16k': {'ext': '.mp3', 'args': ['-ar', '16000', '-ac', '1', '-b:a', '32k']},
+    'opus': {'ext': '.ogg', 'args': ['-ar', '16000', '-ac', '1', '-c:a', 'libopus', '-b:a', '24k', '-application', 'voip']},
+}
+
+class SpeakerBuffer:
+    #In-memory capture of one speaker's current chunk, written from the voice receive thread.
+    #Speech is kept as runs of contiguous mono PCM with their offset from fileStart; silence between runs is not stored.
+    def __init__(self, filename, fileStart):
+        self.filename = filename
+        self.fileStart = fileStart
+        self.runs = []
+        self.bytes_written = 0
+        self.last_packet = None
+
+    def write(self, pcm, now):
+        if not pcm:
+            return
+        samples = array.array('h')
+        samples.frombytes(pcm[:len(pcm) - len(pcm) % (2 * INPUT_CHANNELS * DOWNSAMPLE)])
+        left = samples[::INPUT_CHANNELS]
+        #Each output sample is the mean of DOWNSAMPLE input samples, which also filters out most of what would alias
+        groups = zip(*(left[phase::DOWNSAMPLE] for phase in range(DOWNSAMPLE)))
+        mono = array.array('h', [sum(group) // DOWNSAMPLE for group in groups]).tobytes()
+        offset = max(now - self.fileStart - len(mono) / BYTES_PER_SECOND, 0.0)
+        if self.runs and offset - self.run_end(self.runs[-1]) <= RUN_GAP_SECONDS:
+            self.runs[-1][1].extend(mono)
+        else:
+            self.runs.append((offset, bytearray(mono)))
+        self.bytes_written += len(pcm)
+        self.last_packet = now
+
+    @staticmethod
+    def run_end(run):
+        offset, pcm = run
+        return offset + len(pcm) / BYTES_PER_SECOND
+
+    @property
+    def duration(self):
+        return self.run_end(self.runs[-1]) if self.runs else 0.0
+
+    def timeline(self):
+        #Yields the chunk as continuous PCM from fileStart, with silence filled back in between runs
+        position = 0
+        for offset, pcm in self.runs:
+            gap = int(offset * SAMPLE_RATE) * 2 - position
+            while gap > 0:
+                block = SILENCE_BLOCK[:min(gap, len(SILENCE_BLOCK))]
+                yield block
+                gap -= len(block)
+                position += len(block)
+            yield pcm
+            position += len(pcm)
+
+class EncoderPool:
+    #Encodes finished chunks with at most `size` ffmpeg processes running at once
+    def __init__(self, size, profile='mp3'):
+        self.slots = asyncio.Semaphore(size)
+        self.profile_name = profile
+        self.profile = ENCODING_PROFILES[profile]
+        self.output_args = self.profile['args']
+
+    async def encode(self, buffer):
+        #Returns the written file path, or None if the buffer held no audio
+        if not buffer.runs:
+            return None
+        async with self.slots:
+            with metrics.encode_seconds.time(profile=self.profile_name):
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+                    *self.output_args, buffer.filename,
+                    stdin=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                try:
+                    for block in buffer.timeline():
+                        process.stdin.write(block)
+                        await process.stdin.drain()
+                finally:
+                    process.stdin.close()
+                errors = await process.stderr.read()
+                returncode = await process.wait()
+        if returncode != 0 or not await offload.exists(buffer.filename):
+            print(f"Encoding {buffer.filename} failed: {errors.decode(errors='replace')}")
+            return None
+        return buffer.filename
@@ -0,0 +1,77 @@
+import io
+import discord
+from discord import app_commands
+from discord.ext import commands
+import apiClient
+import metrics
+
+MAX_MESSAGE_LENGTH = 2000
+
+queue_depth = metrics.gauge('glyph_transcription_queue_depth', 'Chunks waiting in the background transcription queue')
+queue_lag = metrics.gauge('glyph_transcription_queue_lag_seconds', 'Age of the oldest chunk waiting for transcription')
+active_sessions = metrics.gauge('glyph_active_sessions', 'Sessions joined to a voice channel')
+recording_sessions = metrics.gauge('glyph_recording_sessions', 'Sessions currently recording')
+lane_limit = metrics.gauge('glyph_openai_lane_limit', 'Current adaptive concurrency limit of each OpenAI lane', ['lane'])
+lane_in_flight = metrics.gauge('glyph_openai_lane_in_flight', 'OpenAI requests running in each lane', ['lane'])
+lane_waiting = metrics.gauge('glyph_openai_lane_waiting', 'OpenAI requests waiting for a slot in each lane', ['lane'])
+
+class Diagnostics(commands.Cog):
+    def __init__(self, bot: commands.Bot) -> None:
+        self.bot = bot
+        self.server = None
+
+    async def cog_load(self):
+        metrics.collectors.append(self.collect)
+        port = apiClient.config.get('metrics_port')
+        if port:
+            self.server = await metrics.serve(port, apiClient.config.get('metrics_host', '127.0.0.1'))
+
+    async def cog_unload(self):
+        if self.collect in metrics.collectors:
+            metrics.collectors.remove(self.collect)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def collect(self):
+        recorder = self.bot.get_cog('Recorder')
+        if recorder is not None:
+            queue_depth.set(recorder.transcription_queue.depth)
+            queue_lag.set(round(recorder.transcription_queue.lag, 3))
+        sessions = getattr(self.bot, 'sessions', {})
+        active_sessions.set(len(sessions))
+        recording_sessions.set(sum(1 for session in sessions.values() if session.is_recording()))
+        for name, lane in apiClient.scheduler.lanes.items():
+            lane_limit.set(round(lane.limit, 2), lane=name)
+            lane_in_flight.set(lane.in_flight, lane=name)
+            lane_waiting.set(len(lane.waiters), lane=name)
+
+    def summary(self):
+        #One line per series: totals for counters and gauges, count and p50/p95/p99 for histograms
+        metrics.collect()
+        lines = []
+        for name, metric in sorted(metrics.registry.items()):
+            if isinstance(metric, metrics.Histogram):
+                for key, (count, total, _) in sorted(metric.snapshot().items()):
+                    labels = metrics.format_labels(metric.labels, key)
+                    quantiles = ' '.join(f"p{round(q * 100)}={metric.quantile(q, key):.3g}" for q in (0.5, 0.95, 0.99))
+                    lines.append(f"{name}{labels} n={count} avg={total / count:.3g} {quantiles}")
+            else:
+                lines.extend(metric.render())
+        return '\n'.join(lines) or 'No metrics recorded yet'
+
+    @app_commands.command(name="metrics", description="Shows pipeline timings and counters. Owner only.")
+    async def show_metrics(self, interaction: discord.Interaction) -> None:
+        if not await self.bot.is_owner(interaction.user):
+            await interaction.response.send_message("Only my owner can look at that!", ephemeral=True)
+            return
+        summary = self.summary()
+        if len(summary) + 8 <= MAX_MESSAGE_LENGTH:
+            await interaction.response.send_message(f"```\n{summary}\n```", ephemeral=True)
+        else:
+            await interaction.response.send_message("Lots of numbers! I put them in a file for you.",
+                                                    file=discord.File(io.BytesIO(metrics.render().encode()), filename='metrics.txt'),
+                                                    ephemeral=True)
+
+async def setup(bot: commands.Bot) -> None:
+    await bot.add_cog(Diagnostics(bot))
@@ -1,13 +1,110 @@
 import os
+import re
 import json
 import discord
+from typing import Optional
 from discord.ext import commands, voice_recv, tasks
 from discord import app_commands
+import apiClient
+import segmentStore
+import transcriptIndex
+import vectorIndex
+from sessionJournal import JournaledSession
 
+MAX_MESSAGE_LENGTH = 2000
+SESSION_NAME = re.compile(r'^(\d+)_(\d+)_(\d+)(\.json)?$')
 
 class Notes(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
         self.bot = bot
 
+    def campaign_id_for(self, guild_id, campaign_name):
+        for campaign_id, campaign in self.bot.roster.campaigns.items():
+            if campaign['campaign_name'] == campaign_name and campaign['guild_id'] in (guild_id, None):
+                return campaign_id
+        return None
+
+    @app_commands.command(name="search", description="Search what was said in past sessions.")
+    async def search(self, interaction: discord.Interaction, query: str, campaign: Optional[str] = None) -> None:
+        if not query.strip():
+            await interaction.response.send_message("What should I look for?", ephemeral=True)
+            return
+        campaign_id = None
+        if campaign:
+            campaign_id = self.campaign_id_for(interaction.guild_id, campaign)
+            if campaign_id is None:
+                await interaction.response.send_message(f"I don't know a campaign called '{campaign}'.", ephemeral=True)
+                return
+        try:
+            hits = await transcriptIndex.search(self.bot.db, interaction.guild_id, query, campaign_id)
+        except Exception as e:
+            await interaction.response.send_message(f"Search failed! Oh no! This happened:\n{str(e)}")
+            return
+        if not hits:
+            await interaction.response.send_message(f"I couldn't find anything about '{query}'.")
+            return
+        response = f"Here's what I found about '{query}':\n"
+        for campaign_name, session_number, speaker, start_seconds, excerpt in hits:
+            line = f"**{campaign_name}** session {session_number} [{apiClient.seconds_to_hhmm(start_seconds)}] {speaker}: {excerpt}\n"
+            if len(response) + len(line) > MAX_MESSAGE_LENGTH:
+                break
+            response += line
+        await interaction.response.send_message(response)
+
+    @app_commands.command(name="ask", description="Ask a question about a campaign's past sessions.")
+    async def ask(self, interaction: discord.Interaction, question: str, campaign: str) -> None:
+        campaign_id = self.campaign_id_for(interaction.guild_id, campaign)
+        if campaign_id is None:
+            await interaction.response.send_message(f"I don't know a campaign called '{campaign}'.", ephemeral=True)
+            return
+        #Retrieval and the chat call can take longer than the 3 seconds Discord gives us to respond
+        await interaction.response.defer(thinking=True)
+        try:
+            answer = await vectorIndex.answer(interaction.guild_id, campaign_id, question)
+        except Exception as e:
+            await interaction.followup.send(f"I couldn't work that out! Oh no! This happened:\n{str(e)}")
+            return
+        if answer is None:
+            await interaction.followup.send(f"I don't have any sessions of {campaign} to look through yet.")
+            return
+        await interaction.followup.send(answer[:MAX_MESSAGE_LENGTH])
+
+    @search.autocomplete('campaign')
+    @ask.autocomplete('campaign')
+    async def autocomplete_campaign(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice]:
+        return [
+            app_commands.Choice(name=campaign_name, value=campaign_name)
+            for campaign_name in self.bot.roster.autocomplete(interaction.guild_id, current)
+        ]
+
+    @commands.command()
+    @commands.is_owner()
+    async def reindexTranscripts(self, ctx):
+        #Re-runs combine_transcripts over every stored session so sessions recorded before search and /ask existed are indexed
+        #Through the loaded cog rather than an import, so this still works after the recorder is reloaded
+        recorder = self.bot.get_cog('Recorder')
+        if recorder is None:
+            await ctx.send("The recorder isn't loaded, so I can't reindex right now.")
+            return
+        sessions = set()
+        if os.path.isdir(segmentStore.TRANSCRIPTS_DIR):
+            for name in os.listdir(segmentStore.TRANSCRIPTS_DIR):
+                match = SESSION_NAME.match(name)
+                if match:
+                    sessions.add(tuple(int(part) for part in match.groups()[:3]))
+        indexed = 0
+        for guild_id, campaign_id, session_number in sorted(sessions):
+            if campaign_id not in self.bot.roster.campaigns:
+                continue
+            session = JournaledSession(self.bot.journal, None, guild_id, campaign_id, session_number, None, None, None)
+            result = await recorder.combine(session)
+            if result is not None and result >= 0:
+                indexed += 1
+                try:
+                    await vectorIndex.index_session(guild_id, campaign_id, session_number)
+                except Exception as e:
+                    print(f"Failed to index session {session_number} for /ask: {e}")
+        await ctx.send(f"Reindexed {indexed} of {len(sessions)} sessions")
+
 async def setup(bot: commands.Bot) -> None:
-    await bot.add_cog(Notes(bot))
\ No newline at end of file
+    await bot.add_cog(Notes(bot))
@@ -1,14 +1,33 @@
 import discord
+import asyncio
 import os
 import time
 import json
-from discord.ext import commands, voice_recv, tasks
+from discord.ext import commands, voice_recv
 from discord import app_commands
 import aiofiles
 import apiClient
-
-MAX_FILE_SIZE_MB = 1
+import segmentStore
+from rollingSummary import RollingSummarizer
+from transcriptionQueue import TranscriptionQueue, ExternalTranscriptionQueue
+import jobQueue
+from capture import SpeakerBuffer, EncoderPool
+from transcriptIndex import SegmentIndexer
+import vectorIndex
+import sessionJournal
+import metrics
+import offload
+import compaction
+
+#Chunks rotate once they reach either limit. Past ROTATION_SOFT_RATIO of a limit they rotate at the
+#next pause in speech instead, so most cuts land on silence. Bytes are captured PCM.
+MAX_CHUNK_SECONDS = apiClient.config.get('max_chunk_seconds', 300)
+MAX_CHUNK_BYTES = apiClient.config.get('max_chunk_mb', 64) * 1024 * 1024
+ROTATION_SOFT_RATIO = 0.8
+ROTATION_SILENCE_SECONDS = apiClient.config.get('rotation_silence_seconds', 0.5)
 MAX_MESSAGE_LENGTH = 2000
+#Merged segments are written out in batches of this many lines
+COMBINE_WRITE_BATCH = 500
 
 class CampaignSelectButton(discord.ui.Button):
     def __init__(self, campaign_id: int, campaign_name: str, view):
@@ -32,16 +51,20 @@ class CampaignSelectView(discord.ui.View):
             self.add_item(CampaignSelectButton(campaign_id, campaign_name, self))
 
 class RecordingSession:
-    def __init__(self, guild_id, voice_client, campaign):
+    def __init__(self, guild_id, voice_client, campaign, journal):
         self.guild_id = guild_id
         self.voice_client = voice_client
         self.user_sinks = {}
         self.user_fileStart = {}
+        self.rotations = []
         self.recording = False
         self.campaign_name = campaign['campaign_name']
         self.campaign_id = campaign['campaign_id']
         self.session_number = campaign['total_sessions']+1
         self.session_start = None
+        self.summarizer = None
+        self.journal = journal
+        self.session_id = None
 
     def start_recording(self):
         self.recording = True
@@ -49,14 +72,14 @@ class RecordingSession:
             self.session_start = round(time.time())
 
     def stop_recording(self):
+        #Hands back the unfinished buffers so the caller can encode and transcribe them
         self.recording = False
-        for sink in self.user_sinks.values():
-            sink.cleanup()
+        buffers = list(self.user_sinks.items())
         self.user_sinks.clear()
+        return buffers
 
-    def add_user_sink(self, user, sink):
-        self.user_sinks[user] = sink
-        sink.fileStart = round(time.time())
+    def add_user_sink(self, user, filename, now=None):
+        self.user_sinks[user] = SpeakerBuffer(filename, round(now or time.time()))
 
     def is_recording(self):
         return self.recording
@@ -64,23 +87,68 @@ class RecordingSession:
 class Recorder(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
         self.bot = bot
-        self.file_size_monitor.start()
-    
-    @tasks.loop(seconds=60)
-    async def file_size_monitor(self):
-        for session in self.bot.sessions.values():
-            if session.is_recording():
-                for user, sink in session.user_sinks.items():
-                    filename = sink.filename
-                    if os.path.exists(filename):
-                        file_size_mb = os.path.getsize(filename) / (1024 * 1024)
-                        print(f'File size for {filename} currently {file_size_mb}')
-                        if file_size_mb >= MAX_FILE_SIZE_MB:
-                            await self.handle_file_size_limit_reached(session, user)
-
-    async def handle_file_size_limit_reached(self, session, user):
-        current_file = session.user_sinks[user].filename
-        file_start = session.user_sinks[user].fileStart
+        self.transcription_queue = TranscriptionQueue()
+        self.encoder_pool = EncoderPool(apiClient.config.get('encoder_pool_size', 2), apiClient.TRANSCRIPTION_FORMAT)
+        #Set in worker_mode 'external', where transcription, merging and notes run in worker.py processes
+        self.jobs = None
+
+    async def cog_load(self):
+        if apiClient.config.get('worker_mode', 'inline') == 'external':
+            self.jobs = await jobQueue.open_job_queue(apiClient.config.get('job_queue', {}))
+            self.transcription_queue = ExternalTranscriptionQueue(self.jobs)
+        self.transcription_queue.start()
+
+    async def cog_unload(self):
+        await self.transcription_queue.stop()
+        if self.jobs is not None:
+            await self.jobs.close()
+
+    async def transcribe_files(self, session, files, priority=apiClient.LIVE):
+        if self.jobs is None:
+            return await apiClient.transcribe_files(files, session, priority)
+        try:
+            return await self.jobs.run('transcribe', {'session': jobQueue.session_payload(session), 'files': files, 'priority': priority}, priority)
+        except jobQueue.JobFailed as e:
+            print(f"Transcription job failed: {e}")
+            return []
+
+    async def combine(self, session):
+        if self.jobs is None:
+            return await combine_transcripts(session=session, bot=self.bot)
+        try:
+            result = await self.jobs.run('combine', {'session': jobQueue.session_payload(session)}, apiClient.NOTES,
+                                         dedupe_key=f'combine:{session.guild_id}_{session.campaign_id}_{session.session_number}')
+        except jobQueue.JobFailed as e:
+            print(f"Combine job failed: {e}")
+            return None
+        #The worker only frees its own copy
+        segmentStore.close_session(session.guild_id, session.campaign_id, session.session_number)
+        return result
+
+    async def notes(self, session):
+        if self.jobs is None:
+            return await apiClient.generate_notes(session=session)
+        try:
+            return await self.jobs.run('notes', {'session': jobQueue.session_payload(session)}, apiClient.NOTES,
+                                       dedupe_key=f'notes:{session.guild_id}_{session.campaign_id}_{session.session_number}')
+        except jobQueue.JobFailed as e:
+            print(f"Notes job failed: {e}")
+            return None
+
+    def should_rotate(self, sink, now):
+        elapsed = now - sink.fileStart
+        if elapsed >= MAX_CHUNK_SECONDS or sink.bytes_written >= MAX_CHUNK_BYTES:
+            return True
+        near_limit = elapsed >= MAX_CHUNK_SECONDS * ROTATION_SOFT_RATIO or sink.bytes_written >= MAX_CHUNK_BYTES * ROTATION_SOFT_RATIO
+        #The packet being handled ends a pause, so cutting here puts the boundary in the silence
+        paused = sink.last_packet is not None and now - sink.last_packet >= ROTATION_SILENCE_SECONDS
+        return near_limit and paused
+
+    def rotate_sink(self, session, user, now=None):
+        #Called from the voice receive thread. A fresh buffer is swapped in before the next packet is written,
+        #encoding the old one and queueing its transcription happen on the event loop.
+        old_sink = session.user_sinks[user]
+        current_file = old_sink.filename
         base_name, ext = os.path.splitext(current_file)
 
         parts = base_name.split('_')
@@ -91,10 +159,131 @@ class Recorder(commands.Cog):
         new_base_name = '_'.join(parts)
         new_filename = f"{new_base_name}{ext}"
 
-        session.user_sinks[user].cleanup()
-        session.add_user_sink(user, voice_recv.FFmpegSink(filename=new_filename))
+        session.add_user_sink(user, new_filename, now)
         print(f"Switched to new file: {new_filename}")
-        await apiClient.transcribe_file(current_file,user.id,session,file_start)
+        metrics.rotations.inc()
+        session.rotations.append(asyncio.run_coroutine_threadsafe(self.finish_chunk(old_sink, user.id, session), self.bot.loop))
+
+    def capture_packet(self, session, user, data, now=None):
+        #Runs on the voice receive thread for every packet. `now` is only passed by the pipeline benchmark,
+        #which replays packets faster than real time.
+        if now is None:
+            now = time.time()
+        if user not in session.user_sinks:
+            print("Found new user")
+            base_filename = f"{session.campaign_id}_{session.session_number}_{user.name}_"
+            ext = self.encoder_pool.profile['ext']
+            index = 1
+            filename = f"{base_filename}{index}{ext}"
+
+            while os.path.exists(filename):
+                index += 1
+                filename = f"{base_filename}{index}{ext}"
+
+            session.add_user_sink(user, filename, now)
+
+        if self.should_rotate(session.user_sinks[user], now):
+            self.rotate_sink(session, user, now)
+        session.user_sinks[user].write(data.pcm, now)
+        metrics.capture_bytes.inc(len(data.pcm), user=user.id)
+
+    async def finish_chunk(self, buffer, userID, session):
+        file_path = await self.encoder_pool.encode(buffer)
+        if file_path is not None:
+            await session.journal.record_chunk(session, userID, file_path, buffer.fileStart, buffer.duration)
+            self.transcription_queue.enqueue(file_path, userID, session, buffer.fileStart, buffer.duration)
+
+    async def encode_buffers(self, session, buffers):
+        #Encodes the buffers left over when recording stops and returns them in transcribe_files form
+        paths = await asyncio.gather(*(self.encoder_pool.encode(buffer) for _, buffer in buffers))
+        files = [{'file': path, 'userID': user.id, 'start': buffer.fileStart, 'duration': buffer.duration} for (user, buffer), path in zip(buffers, paths) if path is not None]
+        for each in files:
+            await session.journal.record_chunk(session, each['userID'], each['file'], each['start'], each['duration'])
+        return files
+
+    async def drain_session(self, session):
+        #Waits for rotated chunks to be closed and queued, then for the queue to finish them
+        rotations, session.rotations = session.rotations, []
+        await asyncio.gather(*(asyncio.wrap_future(rotation) for rotation in rotations), return_exceptions=True)
+        return await self.transcription_queue.drain(session)
+
+    async def send_notes(self, send, session, notes):
+        #send is interaction.followup.send or a channel's send
+        try:
+            if len(notes) <= MAX_MESSAGE_LENGTH:
+                print("Notes not too long")
+                await send(notes)
+            else:
+                note_path = f'notes/{session.guild_id}_{session.campaign_id}_{session.session_number}_summary.txt'
+                print(f"Notes too long, note filepath is {note_path}")
+                await send(content="Too many notes to type! I put them in a file for you.",
+                                            file=discord.File(note_path))
+        except Exception as e:
+                print(f"Failed to send notes: {e}")
+
+    async def resume_unfinished(self):
+        #Finishes the sessions a crash or restart left behind. Every step is safe to repeat: chunks already in the
+        #segment store are skipped and the merge and notes are rewritten from scratch.
+        sessions = [session for session in await self.bot.journal.unfinished_sessions() if self.owns_guild(session.guild_id)]
+        if not sessions:
+            return
+        print(f"Resuming {len(sessions)} unfinished sessions")
+        await asyncio.gather(*(self.resume_session(session) for session in sessions), return_exceptions=True)
+
+    def owns_guild(self, guild_id):
+        #With shards split across processes each one resumes only its own guilds, so no session is finished twice.
+        #discord.py places a guild on shard (guild_id >> 22) % shard_count.
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        shard_count = getattr(self.bot, 'shard_count', None)
+        if not shard_ids or not shard_count:
+            return True
+        return (guild_id >> 22) % shard_count in shard_ids
+
+    async def resume_session(self, session):
+        files = await self.bot.journal.pending_chunks(session)
+        print(f"Resuming session {session.session_number} of campaign {session.campaign_id} with {len(files)} chunks to transcribe")
+        transcribed = 0
+        if files:
+            results = await self.transcribe_files(session, files, apiClient.BACKGROUND)
+            for result in results:
+                if result['status'] == 'missing':
+                    #The audio is gone, so there is nothing left to retry
+                    await self.bot.journal.chunk_transcribed(session, result['file'])
+            transcribed = sum(1 for result in results if result['status'] == 'transcribed')
+            failed = sum(1 for result in results if result['status'] == 'failed')
+            if failed:
+                print(f"{failed} chunks of session {session.session_number} of campaign {session.campaign_id} failed again, retrying on the next restart")
+        if session.status in (sessionJournal.SUMMARIZED, sessionJournal.EMPTY) and not transcribed:
+            #Notes were already sent, and without new segments they would come out the same
+            return
+        if files or session.status != sessionJournal.MERGED:
+            segment_count = await self.combine(session)
+            if segment_count == -1:
+                await self.bot.journal.advance(session, sessionJournal.EMPTY)
+                return
+            if segment_count is None:
+                return
+        notes = await self.notes(session)
+        if not isinstance(notes, str):
+            return
+        await index_for_ask(session)
+        await self.bot.wait_until_ready()
+        channel = self.bot.get_channel(session.channel_id) if session.channel_id else None
+        if channel is None:
+            return
+        campaign = self.bot.roster.campaigns.get(session.campaign_id)
+        campaign_name = campaign['campaign_name'] if campaign else 'the campaign'
+        try:
+            await channel.send(f"I got interrupted, but I finished my notes for {campaign_name} session {session.session_number}!")
+        except Exception as e:
+            print(f"Failed to send notes: {e}")
+            return
+        await self.send_notes(channel.send, session, notes)
+
+    @commands.command()
+    @commands.is_owner()
+    async def queueStatus(self, ctx):
+        await ctx.send(f"Transcription queue depth: {self.transcription_queue.depth}, lag: {round(self.transcription_queue.lag)}s")
 
     async def select_campaign(self, interaction: discord.Interaction, campaigns) -> dict:
         if len(campaigns) == 1:
@@ -152,7 +341,7 @@ class Recorder(commands.Cog):
         if interaction.user.voice:
             try:
                 voice_client = await interaction.user.voice.channel.connect(cls=voice_recv.VoiceRecvClient)
-                session = RecordingSession(interaction.guild.id, voice_client, campaignPick)
+                session = RecordingSession(interaction.guild.id, voice_client, campaignPick, self.bot.journal)
                 self.bot.sessions[interaction.guild.id] = session
                 if interaction.response.is_done():
                     await interaction.followup.send(f"Joined the voice channel! Campaign: {campaignPick['campaign_name']}, Session {campaignPick['total_sessions']+1}")
@@ -178,23 +367,15 @@ class Recorder(commands.Cog):
     async def listen(self, interaction: discord.Interaction) -> None:
         session = self.bot.sessions.get(interaction.guild_id)
         if session and not session.is_recording():
+            #Running notes live in this process, so they are left off when notes are written by external workers
+            if session.summarizer is None and self.jobs is None and apiClient.config.get('rolling_summary', True):
+                session.summarizer = RollingSummarizer(await fetch_name_ref(self.bot, session.campaign_id))
             def callback(user, data: voice_recv.VoiceData):
-                if user not in session.user_sinks:
-                    print("Found new user")
-                    base_filename = f"{session.campaign_id}_{session.session_number}_{user.name}_"
-                    index = 1
-                    filename = f"{base_filename}{index}.mp3"
-
-                    while os.path.exists(filename):
-                        index += 1
-                        filename = f"{base_filename}{index}.mp3"
+                self.capture_packet(session, user, data)
 
-                    session.add_user_sink(user, voice_recv.FFmpegSink(filename=filename))
-
-                session.user_sinks[user].write(user, data)
-
-            session.voice_client.listen(voice_recv.BasicSink(callback))
             session.start_recording()
+            await session.journal.open_session(session, interaction.channel_id)
+            session.voice_client.listen(voice_recv.BasicSink(callback))
             await interaction.response.send_message("I'm ready!")
         elif not session:
             await interaction.response.send_message("What? I'm not prepared yet! Tell me which channel to join.")
@@ -209,14 +390,11 @@ class Recorder(commands.Cog):
             await interaction.response.send_message("Ok! Taking a break for now")
             print("Recording in stop command")
             session.voice_client.stop_listening()
-            files_to_transcribe = [{'file':sink.filename,'userID':user.id,'start':sink.fileStart} for user,sink in session.user_sinks.items()]
-            session.stop_recording()
+            buffers = session.stop_recording()
             print("Stopped recording")
-
-            for each in files_to_transcribe:
-                if os.path.exists(each['file']):
-                    await apiClient.transcribe_file(each['file'],each['userID'],session,each['start'])
-                    print(f"Transcribed file: {each['file']}")
+            await self.drain_session(session)
+            #Everything captured is transcribed now, the session may never see a /done
+            await self.transcribe_files(session, await self.encode_buffers(session, buffers))
         else:
             await interaction.response.send_message("What? I'm not listening right now.")
         print("Stop command finished")
@@ -230,31 +408,22 @@ class Recorder(commands.Cog):
             if session.is_recording():
                 print("Session is recording, need to stop")
                 session.voice_client.stop_listening()
-                files_to_transcribe = [{'file':sink.filename,'userID':user.id,'start':sink.fileStart} for user,sink in session.user_sinks.items()]
-                session.stop_recording()
+                buffers = session.stop_recording()
                 print("Stopped recording")
-                for each in files_to_transcribe:
-                    if os.path.exists(each['file']):
-                        await apiClient.transcribe_file(each['file'],each['userID'],session,each['start'])
-                        print(f"Transcribed file: {each['file']}")
+                #Rotated chunks still in the background queue are finished first
+                await self.drain_session(session)
+                await self.transcribe_files(session, await self.encode_buffers(session, buffers))
             del self.bot.sessions[interaction.guild_id]
             print("Session deleted")
             await session.voice_client.disconnect()
-            await combine_transcripts(session=session,bot=self.bot)
-            notes = await apiClient.generate_notes(session=session)
+            await self.combine(session)
+            notes = await self.notes(session)
+            #Embedding runs in the background, /ask picks the session up once it lands
+            task = asyncio.create_task(index_for_ask(session))
+            index_tasks.add(task)
+            task.add_done_callback(index_tasks.discard)
             await interaction.followup.send("Notes are ready!")
-            try:
-                if len(notes) <= MAX_MESSAGE_LENGTH:
-                    print("Notes not too long")
-                    await interaction.followup.send(notes)
-                else:
-                    note_path = f'notes/{session.guild_id}_{session.campaign_id}_{session.session_number}_summary.txt'
-                    print(f"Notes too long, note filepath is {note_path}")
-                    await interaction.followup.send(content="Too many notes to type! I put them in a file for you.",
-                                                file=discord.File(note_path))
-            except Exception as e:
-                    print(f"Failed to send notes: {e}")
-                    return
+            await self.send_notes(interaction.followup.send, session, notes)
         else:
             await interaction.response.send_message("I don't have anything to wrap up but alrighty.")
         print("Done command finished")
@@ -272,28 +441,20 @@ class Recorder(commands.Cog):
             await interaction.response.send_message("I can't leave something I'm not in!")
         print("Leave command finished")
 
-async def combine_transcripts(session=None, guild_id=None, campaign_id=None, session_number=None, user_id=None,bot=None):
-    print("Combining!")
-    if bot is None:
-        print("Need bot!")
-        return -1
+#Keeps a reference to running /ask indexing tasks so they aren't garbage collected mid-run
+index_tasks = set()
 
-    if session is not None:
-        guild_id = getattr(session, 'guild_id', guild_id)
-        campaign_id = getattr(session, 'campaign_id', campaign_id)
-        session_number = getattr(session, 'session_number', session_number)
-
-    transcript_file = f'transcripts/{guild_id}_{campaign_id}_{session_number}.json'
-    print(f"Working with transcript file {transcript_file}")
+async def index_for_ask(session):
+    try:
+        await vectorIndex.index_session(session.guild_id, session.campaign_id, session.session_number)
+    except Exception as e:
+        print(f"Failed to index session {session.session_number} for /ask: {e}")
 
-    if os.path.exists(transcript_file):
-        with open(transcript_file, "r") as json_file:
-            session_transcripts = json.load(json_file) 
-    else:
-        print(f"No transcripts located for filepath {transcript_file}")
-        return -1
-
-    all_segments = []
+async def fetch_name_ref(bot, campaign_id):
+    #Maps user IDs to display names for transcripts: the GM is "DM", players are their character names
+    roster = getattr(bot, 'roster', None)
+    if roster is not None and roster.name_ref(campaign_id) is not None:
+        return roster.name_ref(campaign_id)
     nameRef = {}
     async with bot.db.acquire() as conn:
             async with conn.cursor() as cursor:
@@ -316,28 +477,84 @@ async def combine_transcripts(session=None, guild_id=None, campaign_id=None, ses
                         nameRef[str(player_id)] = character_name
                 except Exception as e:
                     print(f"Query for DM/player data failed: {e}")
-                    return
+                    return None
+    return nameRef
+
+async def combine_transcripts(session=None, guild_id=None, campaign_id=None, session_number=None, user_id=None,bot=None):
+    print("Combining!")
+    started = time.perf_counter()
+    if bot is None:
+        print("Need bot!")
+        return -1
+
+    if session is not None:
+        guild_id = getattr(session, 'guild_id', guild_id)
+        campaign_id = getattr(session, 'campaign_id', campaign_id)
+        session_number = getattr(session, 'session_number', session_number)
+
+    await segmentStore.migrate_legacy_transcript(guild_id, campaign_id, session_number)
+    user_ids = segmentStore.list_users(guild_id, campaign_id, session_number)
+    print(f"Working with transcripts in {segmentStore.session_dir(guild_id, campaign_id, session_number)}")
+
+    if not user_ids:
+        print(f"No transcripts located for session {guild_id}_{campaign_id}_{session_number}")
+        return -1
+
+    nameRef = await fetch_name_ref(bot, campaign_id)
+    if nameRef is None:
+        return
     print("Retrieved DM/Player data:",nameRef)
-    for user_id, user_transcripts in session_transcripts.items():
-        for session_segments in user_transcripts:
-            for segment in session_segments:
-                segment_with_user = {
-                    'name': nameRef.get(str(user_id), str(user_id)),
-                    'start_seconds': segment['start_seconds'],
-                    'end_seconds': segment['end_seconds'],
-                    'text': segment['text']
-                }
-                all_segments.append(segment_with_user)
-
-    all_segments_sorted = sorted(all_segments, key=lambda x: x['start_seconds'])
-    print("Segments sorted!",all_segments_sorted)
-    async with aiofiles.open(f'transcripts/{guild_id}_{campaign_id}_{session_number}_sorted.json', "w") as output_file:
-        json_string = json.dumps(all_segments_sorted, indent=4)
-        await output_file.write(json_string)
-    async with aiofiles.open(f'notes/{guild_id}_{campaign_id}_{session_number}_transcript.txt', 'w') as file:
-        for segment in all_segments_sorted:
-            line = f"{segment['name']} - {segment['start_seconds']}:{segment['text']}\n"
-            await file.write(line)
+    await offload.makedirs('notes')
+    segment_count = 0
+    json_buffer = []
+    text_buffer = []
+    raw_buffer = []
+    #The notes transcript is compacted; _sorted.json keeps every segment as transcribed
+    compactor = compaction.TranscriptCompactor()
+    indexer = SegmentIndexer(bot.db, guild_id, campaign_id, session_number, getattr(session, 'session_start', None))
+    async with aiofiles.open(f'transcripts/{guild_id}_{campaign_id}_{session_number}_sorted.json', "w") as output_file, \
+               aiofiles.open(f'notes/{guild_id}_{campaign_id}_{session_number}_transcript.txt', 'w') as file:
+        await output_file.write('[\n')
+        async for user_id, segment in segmentStore.merge_session(guild_id, campaign_id, session_number):
+            segment_with_user = {
+                'name': nameRef.get(str(user_id), str(user_id)),
+                'start_seconds': segment['start_seconds'],
+                'end_seconds': segment['end_seconds'],
+                'text': segment['text']
+            }
+            json_buffer.append(('    ' if segment_count == 0 else ',\n    ') + json.dumps(segment_with_user))
+            raw_buffer.append(f"{segment_with_user['name']} - {segment_with_user['start_seconds']}:{segment_with_user['text']}\n")
+            text_buffer.extend(compactor.add(segment_with_user['name'], segment['start_seconds'], segment['end_seconds'], segment['text'], compaction.likely_silence(segment)))
+            indexer.add(user_id, segment_with_user['name'], segment)
+            segment_count += 1
+            if len(json_buffer) >= COMBINE_WRITE_BATCH:
+                await output_file.write(''.join(json_buffer))
+                await file.write(''.join(text_buffer))
+                await count_transcript_tokens(raw_buffer, text_buffer)
+                json_buffer.clear()
+                text_buffer.clear()
+                raw_buffer.clear()
+        text_buffer.extend(compactor.finish())
+        await output_file.write(''.join(json_buffer) + '\n]\n')
+        await file.write(''.join(text_buffer))
+        await count_transcript_tokens(raw_buffer, text_buffer)
+    print(f"Segments merged! {segment_count} segments written")
+    try:
+        await indexer.write()
+    except Exception as e:
+        #Search is a side feature, the notes still get made without it
+        print(f"Failed to index session {session_number} for search: {e}")
+    metrics.combine_seconds.observe(time.perf_counter() - started)
+    metrics.combine_segments.inc(segment_count)
+    journal = getattr(session, 'journal', None)
+    if journal is not None:
+        await journal.advance(session, sessionJournal.MERGED)
+    segmentStore.close_session(guild_id, campaign_id, session_number)
+    return segment_count
+
+async def count_transcript_tokens(raw_lines, compacted_lines):
+    metrics.transcript_tokens.inc(await offload.run_io(compaction.count_tokens, ''.join(raw_lines)), stage='merged')
+    metrics.transcript_tokens.inc(await offload.run_io(compaction.count_tokens, ''.join(compacted_lines)), stage='compacted')
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(Recorder(bot))
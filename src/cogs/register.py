@@ -19,10 +19,12 @@ class Register(commands.GroupCog, name="register"):
             async with conn.cursor() as cursor:
                 try:
                     await cursor.execute(
-                        "INSERT INTO campaigns (campaign_name, gm_id) VALUES (?, ?)",
-                        (campaign_name, interaction.user.id)
+                        "INSERT INTO campaigns (campaign_name, gm_id, guild_id) VALUES (?, ?, ?) RETURNING campaign_id",
+                        (campaign_name, interaction.user.id, interaction.guild_id)
                     )
+                    campaign_id = (await cursor.fetchone())[0]
                     await conn.commit()
+                    self.bot.roster.add_campaign(campaign_id, campaign_name, interaction.user.id, interaction.guild_id)
                     await interaction.response.send_message(f"Campaign '{campaign_name}' registered successfully!")
                 except Exception as e:
                     await conn.rollback()
@@ -48,10 +50,12 @@ class Register(commands.GroupCog, name="register"):
                     campaign_id = campaign_id[0]
 
                     await cursor.execute(
-                        "INSERT INTO players (campaign_id, character_name) VALUES (?, ?)",
+                        "INSERT INTO players (campaign_id, character_name) VALUES (?, ?) RETURNING player_id",
                         (campaign_id, character_name)
                     )
+                    player_id = (await cursor.fetchone())[0]
                     await conn.commit()
+                    self.bot.roster.add_player(campaign_id, player_id, character_name)
                     await interaction.response.send_message(f"Character '{character_name}' registered successfully under campaign '{campaign_name}'!")
                 except Exception as e:
                     await conn.rollback()
@@ -59,19 +63,11 @@ class Register(commands.GroupCog, name="register"):
 
     @character.autocomplete('campaign_name')
     async def autocomplete_campaign_name(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice]:
-        async with self.bot.db.acquire() as conn:
-            async with conn.cursor() as cursor:
-                try:
-                    await cursor.execute("SELECT campaign_name FROM campaigns")
-                    campaigns = await cursor.fetchall()
-
-
-                    return [
-                        app_commands.Choice(name=campaign[0], value=campaign[0])
-                        for campaign in campaigns if current.lower() in campaign[0].lower()
-                    ][:25]
-                except Exception as e:
-                    await interaction.response.send_message(f"Failed to register character: {str(e)}")
+        #Served from the roster cache's prefix index, the database is never touched while typing
+        return [
+            app_commands.Choice(name=campaign_name, value=campaign_name)
+            for campaign_name in self.bot.roster.autocomplete(interaction.guild_id, current)
+        ]
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(Register(bot))
@@ -0,0 +1,179 @@
+import re
+
+#Turns merged transcript segments into the compact text the chat model is given. _sorted.json keeps every
+#segment with its exact times; the prompt only needs who said what and roughly when:
+#  [00:12]
+#  Aria: We should head back to the tavern. Does anyone have rope?
+#  Bram: I do, and a grappling hook.
+#Consecutive segments from one speaker become one line, times become minute markers, and filler words and
+#Whisper's silence hallucinations are dropped.
+SETTINGS = {
+    #Same-speaker segments this close together are merged, as long as the line covers at most max_block_seconds
+    'merge_gap_seconds': 8,
+    'max_block_seconds': 90,
+    'marker_minutes': 1,
+    'drop_fillers': True,
+    'hallucinations': [],
+}
+TOKENIZER_MODEL = 'gpt-4o'
+
+FILLER_WORDS = re.compile(r"(?<!-)\b(?:u+h+|u+m+|u+h+m+|e+r+m+|h+m+|m+h+m+|m{2,})\b(?!-)[,.!?]*\s*", re.IGNORECASE)
+#"like" and "you know" only count as filler when set off by commas: "it was, like, huge"
+FILLER_PHRASES = re.compile(r",\s+(?:like|you know|I mean),(?=\s)", re.IGNORECASE)
+#Stutters, letters only so numbers ("a 6, 6 and a 2") are never touched: a cut-off word followed by its restart
+#("I- I think", "we... we"), a single letter doubled with a hyphen ("I-I", "w-we"), and a word said three or more
+#times running ("the the the"). A plain double ("had had") or a hyphenated word ("bye-bye") is left alone.
+STUTTER_RESTARTS = re.compile(r"\b([A-Za-z]+)-\s+(?=\1)|\b([A-Za-z]+)(?:\.\.\.|…)\s+(?=\2\b)", re.IGNORECASE)
+STUTTER_LETTERS = re.compile(r"\b([A-Za-z])-(?=\1)", re.IGNORECASE)
+REPEATED_WORDS = re.compile(r"\b([A-Za-z]+)(?:[\s,]+\1\b){2,}", re.IGNORECASE)
+#Whisper sometimes loops on a sentence; three or more copies in a row are collapsed to one
+REPEATED_SENTENCES = re.compile(r"([^.!?\s][^.!?]{0,119}[.!?])(?:\s+\1){2,}")
+#What Whisper tends to write for silence or noise, compared after normalize_text
+HALLUCINATIONS = {
+    'thank you for watching', 'thanks for watching', 'thank you so much for watching', 'thank you very much for watching',
+    'thank you for watching and see you next time', 'please subscribe', 'please like and subscribe', 'like and subscribe',
+    'dont forget to like and subscribe', 'subscribe to my channel', 'subtitles by the amaraorg community',
+    'transcription by castingwords', 'music', 'applause',
+}
+#Also real replies, so only dropped when Whisper's own scores say the segment was probably silence
+SILENCE_HALLUCINATIONS = {'you', 'thank you', 'thanks', 'bye'}
+#Whisper's defaults for treating a segment as silence
+NO_SPEECH_THRESHOLD = 0.6
+LOGPROB_THRESHOLD = -1.0
+#Lines that only acknowledge someone else, dropped first when a transcript is over its token budget
+BACKCHANNEL = {
+    'yeah', 'yeah yeah', 'okay', 'ok', 'oh okay', 'right', 'sure', 'uh-huh', 'cool', 'nice', 'alright', 'all right',
+    'got it', 'gotcha', 'i see', 'oh', 'ah', 'mhm', 'mm-hmm',
+}
+
+def configure(settings, model=None, hallucinations=()):
+    #config 'compaction', the notes model for the tokenizer, and extra texts to treat as hallucinations
+    #(Whisper echoes its prompt back on silent audio)
+    global TOKENIZER_MODEL
+    SETTINGS.update(settings)
+    if model is not None:
+        TOKENIZER_MODEL = model
+    for text in list(SETTINGS['hallucinations']) + list(hallucinations):
+        HALLUCINATIONS.add(normalize_text(text))
+
+def normalize_text(text):
+    return ' '.join(re.sub(r"[^\w\s-]", '', text.lower()).split())
+
+def likely_silence(segment):
+    #segment as persisted; chunks transcribed without Whisper's scores never count as silence
+    no_speech_prob = segment.get('no_speech_prob')
+    avg_logprob = segment.get('avg_logprob')
+    return (no_speech_prob is not None and no_speech_prob > NO_SPEECH_THRESHOLD) or (avg_logprob is not None and avg_logprob < LOGPROB_THRESHOLD)
+
+def clean_text(text, silent=False):
+    #Returns the segment text as it should appear in the prompt, or '' if nothing worth sending is left.
+    #silent is likely_silence() for the segment
+    text = ' '.join(text.split())
+    normalized = normalize_text(text)
+    if not text or normalized in HALLUCINATIONS or (silent and normalized in SILENCE_HALLUCINATIONS):
+        return ''
+    text = REPEATED_SENTENCES.sub(r'\1', text)
+    if SETTINGS['drop_fillers']:
+        capitalized = text[:1].isupper()
+        text = FILLER_PHRASES.sub(',', text)
+        text = FILLER_WORDS.sub('', text)
+        text = STUTTER_RESTARTS.sub('', text)
+        text = STUTTER_LETTERS.sub('', text)
+        text = REPEATED_WORDS.sub(r'\1', text)
+        text = text.strip(' ,')
+        if capitalized:
+            text = text[:1].upper() + text[1:]
+    if not normalize_text(text):
+        return ''
+    return text
+
+def minute_marker(seconds):
+    minutes = int(seconds // 60)
+    return f"[{minutes // 60:02}:{minutes % 60:02}]\n"
+
+class TranscriptCompactor:
+    #Fed segments in start order, hands back finished lines. A line is only finished once the next speaker
+    #starts (or the gap is too long), so call finish() after the last segment.
+    def __init__(self):
+        self.block = None
+        self.marker = None
+
+    def add(self, name, start_seconds, end_seconds, text, silent=False):
+        text = clean_text(text, silent)
+        if not text:
+            return []
+        block = self.block
+        if block is not None and block['name'] == name and start_seconds - block['end'] <= SETTINGS['merge_gap_seconds'] \
+                and end_seconds - block['start'] <= SETTINGS['max_block_seconds']:
+            block['end'] = max(block['end'], end_seconds)
+            block['texts'].append(text)
+            return []
+        lines = self.finish()
+        self.block = {'name': name, 'start': start_seconds, 'end': end_seconds, 'texts': [text]}
+        return lines
+
+    def finish(self):
+        if self.block is None:
+            return []
+        lines = []
+        interval = SETTINGS['marker_minutes'] * 60
+        marker = int(self.block['start'] // interval)
+        if marker != self.marker:
+            self.marker = marker
+            lines.append(minute_marker(marker * interval))
+        lines.append(f"{self.block['name']}: {' '.join(self.block['texts'])}\n")
+        self.block = None
+        return lines
+
+def compact(segments):
+    #segments: (name, start_seconds, end_seconds, text, silent) in start order
+    compactor = TranscriptCompactor()
+    lines = []
+    for segment in segments:
+        lines.extend(compactor.add(*segment))
+    lines.extend(compactor.finish())
+    return ''.join(lines)
+
+#Token counts are estimated at about four characters per token for English. tiktoken is optional: if it is
+#installed, load_tokenizer() makes the counts exact.
+encoding = None
+
+def load_tokenizer():
+    #Called once at startup on the offload thread pool, since the first load downloads the BPE file
+    global encoding
+    try:
+        import tiktoken
+    except ImportError:
+        print("tiktoken not installed, estimating token counts")
+        return
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+        except KeyError:
+            encoding = tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        print(f"Could not load the tiktoken encoding, estimating token counts: {e}")
+
+def count_tokens(text):
+    #Whole transcripts are CPU work with tiktoken, so callers count those on the offload thread pool
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def is_backchannel(line):
+    _, separator, text = line.partition(': ')
+    return bool(separator) and normalize_text(text) in BACKCHANNEL
+
+def fit_to_budget(text, budget):
+    #Returns (text, tokens). Over budget, lines that only acknowledge someone are dropped, along with minute
+    #markers left with nothing under them. Whatever is still over is summarized in parts by the caller.
+    tokens = count_tokens(text)
+    if budget is None or tokens <= budget:
+        return text, tokens
+    lines = [line for line in text.splitlines(keepends=True) if not is_backchannel(line)]
+    kept = [line for index, line in enumerate(lines)
+            if not (line.startswith('[') and (index + 1 == len(lines) or lines[index + 1].startswith('[')))]
+    trimmed = ''.join(kept)
+    trimmed_tokens = count_tokens(trimmed)
+    print(f"Transcript over the {budget} token budget: {tokens} tokens, {trimmed_tokens} after dropping acknowledgements")
+    return trimmed, trimmed_tokens
@@ -0,0 +1,142 @@
+import sqlite3
+
+#Schema migrations for glyph_db.db, applied in order. PRAGMA user_version holds how many have been applied,
+#so each one runs exactly once per database. Append new migrations to the end, never edit applied ones.
+MIGRATIONS = [
+    #1: the original tables, plus indexes for the /join, register and deleteCampaign lookups
+    '''
+    CREATE TABLE IF NOT EXISTS campaigns (
+        campaign_id INTEGER PRIMARY KEY,
+        campaign_name TEXT NOT NULL,
+        gm_id INTEGER NOT NULL,
+        total_sessions INTEGER DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS players (
+        player_id INTEGER PRIMARY KEY,
+        campaign_id INTEGER NOT NULL,
+        character_name TEXT,
+        FOREIGN KEY (campaign_id) REFERENCES campaigns(campaign_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_campaigns_gm_id ON campaigns(gm_id);
+    CREATE INDEX IF NOT EXISTS idx_campaigns_name ON campaigns(campaign_name);
+    CREATE INDEX IF NOT EXISTS idx_players_campaign_id ON players(campaign_id);
+    ''',
+    #2: recorded sessions and their merged transcript segments
+    '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        campaign_id INTEGER NOT NULL,
+        session_number INTEGER NOT NULL,
+        session_start INTEGER,
+        status TEXT NOT NULL DEFAULT 'recording',
+        UNIQUE (guild_id, campaign_id, session_number),
+        FOREIGN KEY (campaign_id) REFERENCES campaigns(campaign_id) ON DELETE CASCADE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_sessions_campaign ON sessions(campaign_id, session_number);
+    CREATE INDEX IF NOT EXISTS idx_sessions_status ON sessions(status);
+
+    CREATE TABLE IF NOT EXISTS segments (
+        segment_id INTEGER PRIMARY KEY,
+        session_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        speaker TEXT,
+        start_seconds REAL NOT NULL,
+        end_seconds REAL NOT NULL,
+        text TEXT NOT NULL,
+        FOREIGN KEY (session_id) REFERENCES sessions(session_id) ON DELETE CASCADE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_segments_session ON segments(session_id, start_seconds);
+    ''',
+    #3: the guild a campaign was registered in, so autocomplete can be scoped to it
+    '''
+    ALTER TABLE campaigns ADD COLUMN guild_id INTEGER;
+
+    CREATE INDEX IF NOT EXISTS idx_campaigns_guild_id ON campaigns(guild_id);
+    ''',
+    #4: full-text index over segment text, kept in step with the segments table by triggers
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(
+        text,
+        content='segments',
+        content_rowid='segment_id',
+        tokenize='porter unicode61'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS segments_fts_insert AFTER INSERT ON segments BEGIN
+        INSERT INTO segments_fts(rowid, text) VALUES (new.segment_id, new.text);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS segments_fts_delete AFTER DELETE ON segments BEGIN
+        INSERT INTO segments_fts(segments_fts, rowid, text) VALUES ('delete', old.segment_id, old.text);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS segments_fts_update AFTER UPDATE OF text ON segments BEGIN
+        INSERT INTO segments_fts(segments_fts, rowid, text) VALUES ('delete', old.segment_id, old.text);
+        INSERT INTO segments_fts(rowid, text) VALUES (new.segment_id, new.text);
+    END;
+
+    INSERT INTO segments_fts(segments_fts) VALUES ('rebuild');
+    ''',
+    #5: the session journal, every recorded audio chunk and how far through the pipeline it has got
+    '''
+    ALTER TABLE sessions ADD COLUMN channel_id INTEGER;
+    ALTER TABLE sessions ADD COLUMN updated_at INTEGER;
+
+    CREATE TABLE IF NOT EXISTS chunks (
+        chunk_id INTEGER PRIMARY KEY,
+        session_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        file_path TEXT NOT NULL,
+        file_start INTEGER NOT NULL,
+        duration REAL,
+        stage TEXT NOT NULL DEFAULT 'recorded',
+        updated_at INTEGER,
+        UNIQUE (session_id, file_path),
+        FOREIGN KEY (session_id) REFERENCES sessions(session_id) ON DELETE CASCADE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_chunks_session_stage ON chunks(session_id, stage);
+
+    --Sessions indexed before the journal existed had already finished
+    UPDATE sessions SET status = 'summarized' WHERE status = 'recording';
+    ''',
+]
+
+def configure_connection(connection: sqlite3.Connection) -> None:
+    #Run on every new connection, including each one in the pool. asqlite already turns on WAL and foreign keys.
+    connection.execute('PRAGMA synchronous = NORMAL')
+    connection.execute('PRAGMA busy_timeout = 5000')
+    connection.execute('PRAGMA cache_size = -16000')
+    connection.execute('PRAGMA temp_store = MEMORY')
+    connection.execute('PRAGMA mmap_size = 134217728')
+
+async def ensure_session(cursor, guild_id, campaign_id, session_number, session_start=None):
+    #Returns the sessions row for this guild/campaign/session, creating it if needed
+    await cursor.execute('''
+        INSERT INTO sessions (guild_id, campaign_id, session_number, session_start)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (guild_id, campaign_id, session_number)
+        DO UPDATE SET session_start = COALESCE(sessions.session_start, excluded.session_start)
+        RETURNING session_id
+    ''', (guild_id, campaign_id, session_number, session_start))
+    return (await cursor.fetchone())[0]
+
+async def migrate(conn):
+    async with conn.cursor() as cursor:
+        await cursor.execute('PRAGMA journal_mode = WAL')
+        await cursor.execute('PRAGMA user_version')
+        version = (await cursor.fetchone())[0]
+        for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Applying database migration {number}")
+            try:
+                await cursor.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;')
+            except Exception:
+                await conn.rollback()
+                raise
+        await cursor.execute('PRAGMA optimize')
+    return len(MIGRATIONS)
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import time
+import asqlite
+
+#Durable queue of pipeline jobs in its own SQLite file, shared by the bot and any number of worker.py processes
+#on the same machine (WAL mode needs shared memory, so the file can't live on a network filesystem).
+#A job is claimed by a single UPDATE, so two workers never run the same one. A worker that dies mid-job leaves
+#it 'running' until its lock times out, and then it is handed out again; every job kind is safe to repeat.
+JOBS_DB = 'glyph_jobs.db'
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    dedupe_key TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, priority, available_at, job_id);
+--At most one live job per dedupe key, so re-submitting the same work after a restart joins the existing job
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs(dedupe_key) WHERE status IN ('queued', 'running');
+'''
+
+def configure_connection(connection):
+    connection.execute('PRAGMA synchronous = NORMAL')
+    connection.execute('PRAGMA busy_timeout = 10000')
+
+class JobFailed(Exception):
+    pass
+
+class JobQueue:
+    def __init__(self, path=JOBS_DB, max_attempts=3, lock_timeout=1800, poll_interval=0.5):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.pool = None
+
+    async def open(self, size=4):
+        self.pool = await asqlite.create_pool(self.path, size=size, init=configure_connection)
+        async with self.pool.acquire() as conn:
+            await conn.executescript(SCHEMA)
+        return self
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def enqueue(self, kind, payload, priority=0, dedupe_key=None):
+        now = time.time()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    INSERT OR IGNORE INTO jobs (kind, payload, dedupe_key, priority, available_at, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    RETURNING job_id
+                ''', (kind, json.dumps(payload), dedupe_key, priority, now, now, now))
+                row = await cursor.fetchone()
+                if row is None:
+                    await cursor.execute("SELECT job_id FROM jobs WHERE dedupe_key = ? AND status IN (?, ?)", (dedupe_key, QUEUED, RUNNING))
+                    row = await cursor.fetchone()
+            await conn.commit()
+        return row[0]
+
+    async def claim(self, worker_id, kinds=None):
+        #Returns (job_id, kind, payload) for the most urgent available job, or None
+        now = time.time()
+        kind_filter = f"AND kind IN ({','.join('?' * len(kinds))})" if kinds else ''
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(f'''
+                    UPDATE jobs SET status = ?, locked_by = ?, locked_at = ?, attempts = attempts + 1, updated_at = ?
+                    WHERE job_id = (
+                        SELECT job_id FROM jobs
+                        WHERE status = ? AND available_at <= ? {kind_filter}
+                        ORDER BY priority, job_id LIMIT 1
+                    )
+                    RETURNING job_id, kind, payload
+                ''', (RUNNING, worker_id, now, now, QUEUED, now, *(kinds or ())))
+                row = await cursor.fetchone()
+            await conn.commit()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    async def complete(self, job_id, result):
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE job_id = ?",
+                               (DONE, json.dumps(result), time.time(), job_id))
+            await conn.commit()
+
+    async def fail(self, job_id, error, retry_delay=5):
+        #Requeued with a delay until max_attempts, then left failed for whoever is waiting on it
+        now = time.time()
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE jobs SET
+                    status = CASE WHEN attempts < ? THEN ? ELSE ? END,
+                    available_at = ?, error = ?, locked_by = NULL, locked_at = NULL, updated_at = ?
+                WHERE job_id = ?
+            ''', (self.max_attempts, QUEUED, FAILED, now + retry_delay, str(error), now, job_id))
+            await conn.commit()
+
+    async def requeue_stale(self):
+        #Hands jobs held by a worker that stopped responding back to the queue
+        now = time.time()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    UPDATE jobs SET status = ?, locked_by = NULL, locked_at = NULL, updated_at = ?
+                    WHERE status = ? AND locked_at < ?
+                ''', (QUEUED, now, RUNNING, now - self.lock_timeout))
+                count = cursor.get_cursor().rowcount
+            await conn.commit()
+        return count
+
+    async def statuses(self, job_ids):
+        placeholders = ','.join('?' * len(job_ids))
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(f"SELECT job_id, status, result, error FROM jobs WHERE job_id IN ({placeholders})", tuple(job_ids))
+                return {job_id: (status, result, error) for job_id, status, result, error in await cursor.fetchall()}
+
+    async def wait(self, job_id):
+        #Polls until the job is done and returns its result, raising JobFailed if it ran out of attempts
+        while True:
+            status, result, error = (await self.statuses([job_id]))[job_id]
+            if status == DONE:
+                return json.loads(result)
+            if status == FAILED:
+                raise JobFailed(error)
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(self, kind, payload, priority=0, dedupe_key=None):
+        return await self.wait(await self.enqueue(kind, payload, priority, dedupe_key))
+
+    async def depth(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) GROUP BY status", (QUEUED, RUNNING))
+                return dict(await cursor.fetchall())
+
+async def open_job_queue(settings):
+    #settings is config 'job_queue': {'path', 'max_attempts', 'lock_timeout', 'poll_interval'}
+    jobs = JobQueue(settings.get('path', JOBS_DB), settings.get('max_attempts', 3), settings.get('lock_timeout', 1800), settings.get('poll_interval', 0.5))
+    return await jobs.open()
+
+def session_payload(session):
+    #What a worker needs to rebuild the session, see worker.session_from
+    return {
+        'session_id': session.session_id,
+        'guild_id': session.guild_id,
+        'campaign_id': session.campaign_id,
+        'session_number': session.session_number,
+        'session_start': session.session_start,
+    }
@@ -2,9 +2,16 @@ from typing import Literal, Optional
 import discord
 import json
 import os
+import sys
 import datetime
 import asqlite
 import asyncio
+import database
+import segmentStore
+import offload
+import compaction
+from rosterCache import RosterCache
+from sessionJournal import SessionJournal
 from discord import app_commands
 from discord.ext import commands
 with open('config.json', 'r') as config_file:
@@ -17,35 +24,17 @@ def get_prefix(bot, message):
     return commands.when_mentioned_or(*prefixes)(bot, message)
 
 async def setup_database():
-    async with asqlite.connect('glyph_db.db') as conn:
-        async with conn.cursor() as cursor:
-            print("Cursor obtained!")
-            await cursor.executescript('''
-                CREATE TABLE IF NOT EXISTS campaigns (
-                    campaign_id INTEGER PRIMARY KEY,
-                    campaign_name TEXT NOT NULL,
-                    gm_id INTEGER NOT NULL,
-                    total_sessions INTEGER DEFAULT 0
-                );
-
-                CREATE TABLE IF NOT EXISTS players (
-                    player_id INTEGER PRIMARY KEY,
-                    campaign_id INTEGER NOT NULL,
-                    character_name TEXT,
-                    FOREIGN KEY (campaign_id) REFERENCES campaigns(campaign_id)
-                );
-            ''')
-            await conn.commit()
-            print("Executed SQL query")
-    
-
-
-
+    async with asqlite.connect('glyph_db.db', init=database.configure_connection) as conn:
+        version = await database.migrate(conn)
+        print(f"Database at schema version {version}")
 
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix=get_prefix,description="A little monster who loves taking notes.", intents=intents)
+#shard_count and shard_ids are left to Discord unless configured. Set both to split the shards across processes;
+#each process then only resumes unfinished sessions for the guilds on its own shards.
+bot = commands.AutoShardedBot(command_prefix=get_prefix,description="A little monster who loves taking notes.", intents=intents,
+                              shard_count=config.get('shard_count'), shard_ids=config.get('shard_ids'))
 
 
 @bot.command()
@@ -136,6 +125,7 @@ async def deleteCampaign(ctx, *, campaign_input: str):
                 )
                 
                 await conn.commit()
+                bot.roster.remove_campaign(campaign_id)
                 await ctx.send(f"Campaign {campaign_id} and associated players deleted successfully.")
             
             except Exception as e:
@@ -171,15 +161,44 @@ async def load_extensions():
             await bot.load_extension(f"cogs.{filename[:-3]}")
             print(f'{filename} loaded!')
 
+async def start_workers():
+    #In worker_mode 'external' this many worker.py processes are started alongside the bot. More can be
+    #started by hand on the same machine.
+    if config.get('worker_mode', 'inline') != 'external':
+        return []
+    workers = []
+    for index in range(config.get('worker_processes', 2)):
+        workers.append(await asyncio.create_subprocess_exec(sys.executable, 'worker.py', '--id', f'local-{index}'))
+    print(f"Started {len(workers)} worker processes")
+    return workers
+
 async def main():
     async with bot:
-        bot.db = await asqlite.create_pool('glyph_db.db')
+        bot.db = await asqlite.create_pool('glyph_db.db', size=config.get('db_pool_size', 5), init=database.configure_connection)
         bot.sessions = {}
         print("Loading Extensions")
         await setup_database()
+        await segmentStore.recover_migrations()
+        await offload.run_io(compaction.load_tokenizer)
+        bot.roster = RosterCache()
+        await bot.roster.load(bot.db)
+        bot.journal = SessionJournal(bot.db)
         await load_extensions()
-        await bot.start(config['discord_key'])
+        #Sessions a crash or restart interrupted are finished in the background while the bot connects
+        resume_task = asyncio.create_task(bot.get_cog('Recorder').resume_unfinished())
+        workers = await start_workers()
+        try:
+            await bot.start(config['discord_key'])
+        finally:
+            resume_task.cancel()
+            await asyncio.gather(resume_task, return_exceptions=True)
+            for worker in workers:
+                worker.terminate()
+                await worker.wait()
+            offload.shutdown()
         bot.start_time = datetime.datetime.now()
         print("Glyph is awake")
 
-asyncio.run(main())
+#Process pool workers started with spawn (the default on Windows) import this module again, they must not log in
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+import asyncio
+import bisect
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+#In-process counters and histograms for the recording pipeline, rendered in the Prometheus text format.
+#Metrics are updated from the voice receive thread as well as the event loop, so every update takes the
+#metric's lock. Label values are passed as keyword arguments and must match the metric's label names.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (16_000, 64_000, 256_000, 1_000_000, 4_000_000, 16_000_000, 64_000_000)
+
+registry = {}
+#Called before every render so gauges read from live objects (queue depth, lane limits) are current
+collectors = []
+
+def label_key(names, labels):
+    if set(labels) != set(names):
+        raise ValueError(f"Expected labels {names}, got {sorted(labels)}")
+    return tuple(str(labels[name]) for name in names)
+
+def format_labels(names, key, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, key)] + [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.labels, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in values]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = label_key(self.labels, labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        #label key -> [per-bucket counts (last one is +Inf), count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(self.labels, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        #{label key: (count, sum, cumulative bucket counts)}
+        with self.lock:
+            return {key: (count, total, list(itertools.accumulate(counts))) for key, (counts, count, total) in self.values.items()}
+
+    def quantile(self, q, key=None):
+        #Estimated the way Prometheus' histogram_quantile does, interpolating inside the bucket the rank falls in.
+        #With key=None every label combination is folded together.
+        snapshot = self.snapshot()
+        series = [snapshot[key]] if key is not None else list(snapshot.values())
+        if not series or not any(count for count, _, _ in series):
+            return None
+        cumulative = [sum(values) for values in zip(*(buckets for _, _, buckets in series))]
+        rank = q * cumulative[-1]
+        index = bisect.bisect_left(cumulative, rank)
+        if index >= len(self.buckets):
+            return self.buckets[-1]
+        lower = self.buckets[index - 1] if index > 0 else 0
+        below = cumulative[index - 1] if index > 0 else 0
+        in_bucket = cumulative[index] - below
+        if in_bucket == 0:
+            return self.buckets[index]
+        return lower + (self.buckets[index] - lower) * (rank - below) / in_bucket
+
+    def render(self):
+        lines = []
+        for key, (count, total, cumulative) in sorted(self.snapshot().items()):
+            for bound, value in zip(self.buckets, cumulative):
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, key, [("le", bound)])} {value}')
+            lines.append(f'{self.name}_bucket{format_labels(self.labels, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+def register(metric):
+    #Returns the metric already registered under this name, so modules reloaded with the cogs keep their totals
+    return registry.setdefault(metric.name, metric)
+
+def counter(name, help_text, labels=()):
+    return register(Counter(name, help_text, labels))
+
+def gauge(name, help_text, labels=()):
+    return register(Gauge(name, help_text, labels))
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return register(Histogram(name, help_text, labels, buckets))
+
+def collect():
+    for collector in list(collectors):
+        try:
+            collector()
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+
+def render():
+    collect()
+    lines = []
+    for name, metric in sorted(registry.items()):
+        lines.append(f'# HELP {name} {metric.help_text}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+async def handle_scrape(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        #Headers are read and ignored
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode(errors='replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(port, host='127.0.0.1'):
+    #Plain HTTP endpoint for a local Prometheus to scrape. Bound to localhost unless configured otherwise.
+    server = await asyncio.start_server(handle_scrape, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+#Pipeline metrics, one per stage
+capture_bytes = counter('glyph_capture_bytes_total', 'PCM bytes received from Discord per speaker', ['user'])
+rotations = counter('glyph_chunk_rotations_total', 'Audio chunks closed by rotation while recording')
+encode_seconds = histogram('glyph_encode_seconds', 'Time to encode one closed audio chunk', ['profile'])
+upload_bytes = histogram('glyph_upload_bytes', 'Size of each audio file sent for transcription', ['backend'], SIZE_BUCKETS)
+transcription_seconds = histogram('glyph_transcription_seconds', 'Transcription backend latency per request', ['backend'])
+transcription_results = counter('glyph_transcriptions_total', 'Chunk transcriptions by outcome', ['status'])
+whisper_cache_lookups = counter('glyph_whisper_cache_lookups_total', 'Whisper cache lookups', ['result'])
+persist_seconds = histogram('glyph_persist_seconds', 'Time to append one chunk of segments to the segment store')
+combine_seconds = histogram('glyph_combine_seconds', 'Time to merge and write one session transcript')
+combine_segments = counter('glyph_combined_segments_total', 'Segments written by combine_transcripts')
+openai_seconds = histogram('glyph_openai_request_seconds', 'OpenAI request latency per attempt', ['lane'])
+openai_wait_seconds = histogram('glyph_openai_queue_seconds', 'Time a request waited for a scheduler lane slot', ['lane'])
+openai_retries = counter('glyph_openai_retries_total', 'OpenAI requests retried after a transient error', ['lane', 'error'])
+chat_tokens = counter('glyph_chat_tokens_total', 'Chat completion tokens used', ['kind'])
+transcript_tokens = counter('glyph_transcript_tokens_total', 'Transcript tokens as merged, after compaction, and as sent for notes', ['stage'])
+notes_seconds = histogram('glyph_notes_seconds', 'Time to produce the notes for one session')
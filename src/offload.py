@@ -0,0 +1,72 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+#Blocking work kept off the event loop, which is also what sends Discord heartbeats and hands voice packets on.
+#File system calls and hashing run on a thread pool; they spend their time in syscalls or C code that
+#releases the GIL. Parsing and rewriting whole transcripts runs in a process pool, since json holds the GIL
+#for the whole document and would stall the voice receive thread along with the loop.
+SETTINGS = {'io_threads': 8, 'cpu_processes': 2}
+
+io_pool = None
+cpu_pool = None
+
+def configure(settings):
+    #config 'offload': {'io_threads', 'cpu_processes'}, applied before the pools are first used
+    SETTINGS.update(settings)
+
+def io_executor():
+    global io_pool
+    if io_pool is None:
+        io_pool = ThreadPoolExecutor(max_workers=SETTINGS['io_threads'], thread_name_prefix='glyph-io')
+    return io_pool
+
+def cpu_executor():
+    global cpu_pool
+    if cpu_pool is None:
+        cpu_pool = ProcessPoolExecutor(max_workers=SETTINGS['cpu_processes'])
+    return cpu_pool
+
+async def run_io(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(io_executor(), functools.partial(func, *args, **kwargs))
+
+async def run_cpu(func, *args):
+    #func and its arguments are pickled, so func must be a module-level function
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor(), func, *args)
+
+async def exists(path):
+    return await run_io(os.path.exists, path)
+
+async def getsize(path):
+    return await run_io(os.path.getsize, path)
+
+async def makedirs(path):
+    await run_io(os.makedirs, path, exist_ok=True)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def remove(path):
+    #Missing files are ignored
+    await run_io(_remove, path)
+
+async def replace(source, destination):
+    await run_io(os.replace, source, destination)
+
+def _read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+async def read_bytes(path):
+    return await run_io(_read_bytes, path)
+
+def shutdown():
+    global io_pool, cpu_pool
+    for pool in (io_pool, cpu_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    io_pool = cpu_pool = None
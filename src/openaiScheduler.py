@@ -0,0 +1,133 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+import openai
+import metrics
+
+#Priority lanes, lower runs first
+LIVE = 0
+NOTES = 1
+BACKGROUND = 2
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+class TokenBucket:
+    #Allows `rate` requests per second on average with bursts of up to `capacity`
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Lane:
+    #Concurrency limit for one kind of request. The limit grows by about one per window of successful calls
+    #that stay under target_latency, and is halved on every 429. Waiters are woken in priority order.
+    def __init__(self, name, requests_per_minute, min_concurrency, max_concurrency, target_latency):
+        self.name = name
+        self.bucket = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute // 10))
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.rate_limited = 0
+
+    async def acquire(self, priority):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            #The slot may have been handed over just before the cancellation landed
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self.waiters and self.in_flight < int(self.limit):
+            _, _, waiter = heapq.heappop(self.waiters)
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def record_success(self, latency):
+        if latency <= self.target_latency:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        else:
+            self.limit = max(self.min_concurrency, self.limit * 0.9)
+
+    def record_rate_limit(self):
+        self.rate_limited += 1
+        self.limit = max(self.min_concurrency, self.limit / 2)
+
+class OpenAIScheduler:
+    #Every Whisper, chat and embedding request goes through run(), which applies the lane's rate limit and
+    #concurrency limit and retries transient failures with jittered exponential backoff
+    def __init__(self, settings):
+        self.max_retries = settings.get('max_retries', 5)
+        self.base_delay = settings.get('base_delay', 1.0)
+        self.max_delay = settings.get('max_delay', 60.0)
+        self.lanes = {
+            'whisper': Lane('whisper', settings.get('whisper_rpm', 50), 1, settings.get('whisper_concurrency', 8), settings.get('whisper_target_latency', 30.0)),
+            'chat': Lane('chat', settings.get('chat_rpm', 500), 1, settings.get('chat_concurrency', 8), settings.get('chat_target_latency', 60.0)),
+            'embedding': Lane('embedding', settings.get('embedding_rpm', 500), 1, settings.get('embedding_concurrency', 4), settings.get('embedding_target_latency', 10.0)),
+        }
+
+    def backoff(self, attempt, error):
+        retry_after = None
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                retry_after = None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def run(self, kind, call, priority=BACKGROUND):
+        #call is a zero-argument coroutine function, so each attempt makes a fresh request
+        lane = self.lanes[kind]
+        attempt = 0
+        while True:
+            queued = time.monotonic()
+            await lane.acquire(priority)
+            try:
+                await lane.bucket.acquire()
+                started = time.monotonic()
+                metrics.openai_wait_seconds.observe(started - queued, lane=kind)
+                result = await call()
+                latency = time.monotonic() - started
+                lane.record_success(latency)
+                metrics.openai_seconds.observe(latency, lane=kind)
+                return result
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, openai.RateLimitError):
+                    lane.record_rate_limit()
+                metrics.openai_retries.inc(lane=kind, error=type(e).__name__)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"{kind} request failed ({type(e).__name__}), retry {attempt + 1} in {delay:.1f}s")
+            finally:
+                lane.release()
+            attempt += 1
+            await asyncio.sleep(delay)
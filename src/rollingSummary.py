@@ -0,0 +1,59 @@
+import asyncio
+import apiClient
+import compaction
+
+#Pending transcript is folded into the running notes once it reaches about this many tokens
+ROLLING_SUMMARY_TOKENS = apiClient.config.get('rolling_summary_tokens', 3000)
+ROLLING_PROMPT = " The session is still being played and you are keeping running notes. Update the existing notes with the new part of the transcript, keeping everything from the existing notes that still matters."
+
+class RollingSummarizer:
+    #Keeps running notes for a live session. Segments are buffered as each chunk is transcribed and folded
+    #into the notes in the background, so /done only has to fold in whatever arrived since the last update.
+    def __init__(self, name_ref=None):
+        self.name_ref = name_ref or {}
+        self.summary = ''
+        self.pending = []
+        self.pending_tokens = 0
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def add_segments(self, userID, segments):
+        name = self.name_ref.get(str(userID), str(userID))
+        for segment in segments:
+            #Counted as it will be sent; filler and hallucinated segments don't bring the next fold closer
+            silent = compaction.likely_silence(segment)
+            text = compaction.clean_text(segment['text'], silent)
+            if not text:
+                continue
+            self.pending.append((segment['start_seconds'], segment['end_seconds'], name, segment['text'], silent))
+            self.pending_tokens += apiClient.estimate_tokens(f"{name}: {text}\n")
+        if self.pending_tokens >= ROLLING_SUMMARY_TOKENS and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.fold())
+
+    async def fold(self, priority=apiClient.BACKGROUND):
+        async with self.lock:
+            if not self.pending:
+                return self.summary
+            pending, self.pending, self.pending_tokens = self.pending, [], 0
+            #Segments from different speakers arrive chunk by chunk, so they are put in order before compacting
+            transcript = compaction.compact((name, start, end, text, silent) for start, end, name, text, silent in sorted(pending, key=lambda entry: entry[0]))
+            content = f"Existing notes:\n{self.summary or '(none yet)'}\n\nNew transcript:\n{transcript}"
+            try:
+                self.summary = await apiClient.complete_notes(apiClient.note_prompt('summary') + ROLLING_PROMPT, content, priority)
+                print(f"Rolling summary updated with {len(pending)} segments")
+            except Exception as e:
+                #Put the segments back so the next fold picks them up
+                print(f"Rolling summary update failed: {e}")
+                self.pending = pending + self.pending
+                self.pending_tokens += apiClient.estimate_tokens(transcript)
+            return self.summary
+
+    async def finish(self):
+        #Folds in the tail of the session. Returns None if the notes could not be brought up to date
+        if self.task is not None:
+            await self.task
+        #Someone is waiting on /done now, so this fold goes ahead of background work
+        await self.fold(apiClient.NOTES)
+        if self.pending or not self.summary:
+            return None
+        return self.summary
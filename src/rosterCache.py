@@ -0,0 +1,81 @@
+import bisect
+
+class RosterCache:
+    #Write-through copy of the campaigns and players tables. Loaded once at startup and then kept in step by
+    #the register commands and deleteCampaign, so lookups made on every keystroke or every session never hit the database.
+    def __init__(self):
+        self.campaigns = {}
+        self.players = {}
+        #guild_id -> sorted [(key, campaign_id)], with one key per word start of each campaign name.
+        #Campaigns registered before guilds were recorded sit under None and are offered in every guild.
+        self.name_index = {}
+
+    async def load(self, db):
+        async with db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT campaign_id, campaign_name, gm_id, guild_id, total_sessions FROM campaigns")
+                campaigns = await cursor.fetchall()
+                await cursor.execute("SELECT player_id, campaign_id, character_name FROM players")
+                players = await cursor.fetchall()
+        self.campaigns.clear()
+        self.players.clear()
+        self.name_index.clear()
+        for campaign_id, campaign_name, gm_id, guild_id, total_sessions in campaigns:
+            self.add_campaign(campaign_id, campaign_name, gm_id, guild_id, total_sessions)
+        for player_id, campaign_id, character_name in players:
+            self.add_player(campaign_id, player_id, character_name)
+        print(f"Roster cache loaded {len(self.campaigns)} campaigns")
+
+    @staticmethod
+    def index_keys(campaign_name):
+        #"The Lost Mine" is found by typing "the", "lost" or "mine"
+        words = campaign_name.lower().split()
+        return {' '.join(words[index:]) for index in range(len(words))}
+
+    def add_campaign(self, campaign_id, campaign_name, gm_id, guild_id=None, total_sessions=0):
+        if campaign_id in self.campaigns:
+            self.remove_campaign(campaign_id)
+        self.campaigns[campaign_id] = {'campaign_name': campaign_name, 'gm_id': gm_id, 'guild_id': guild_id, 'total_sessions': total_sessions}
+        self.players.setdefault(campaign_id, {})
+        entries = self.name_index.setdefault(guild_id, [])
+        for key in self.index_keys(campaign_name):
+            bisect.insort(entries, (key, campaign_id))
+
+    def remove_campaign(self, campaign_id):
+        campaign = self.campaigns.pop(campaign_id, None)
+        self.players.pop(campaign_id, None)
+        if campaign is None:
+            return
+        entries = self.name_index.get(campaign['guild_id'], [])
+        for key in self.index_keys(campaign['campaign_name']):
+            index = bisect.bisect_left(entries, (key, campaign_id))
+            if index < len(entries) and entries[index] == (key, campaign_id):
+                del entries[index]
+
+    def add_player(self, campaign_id, player_id, character_name):
+        self.players.setdefault(campaign_id, {})[player_id] = character_name
+
+    def autocomplete(self, guild_id, current, limit=25):
+        #Campaign names in this guild with a word starting with `current`, in alphabetical key order
+        prefix = current.lower().strip()
+        names = []
+        seen = set()
+        for scope in (guild_id, None):
+            entries = self.name_index.get(scope, [])
+            index = bisect.bisect_left(entries, (prefix,))
+            while index < len(entries) and entries[index][0].startswith(prefix) and len(names) < limit:
+                campaign_id = entries[index][1]
+                if campaign_id not in seen:
+                    seen.add(campaign_id)
+                    names.append(self.campaigns[campaign_id]['campaign_name'])
+                index += 1
+        return names
+
+    def name_ref(self, campaign_id):
+        #Same mapping combine_transcripts builds from the database: the GM is "DM", players are their characters
+        if campaign_id not in self.campaigns:
+            return None
+        nameRef = {str(self.campaigns[campaign_id]['gm_id']): "DM"}
+        for player_id, character_name in self.players.get(campaign_id, {}).items():
+            nameRef[str(player_id)] = character_name
+        return nameRef
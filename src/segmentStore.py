@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import heapq
+import json
+import os
+import shutil
+import aiofiles
+import offload
+try:
+    import fcntl
+except ImportError:
+    #Windows
+    fcntl = None
+    import msvcrt
+
+#Segments are stored append-only, one JSONL file per user inside a directory per session:
+#transcripts/guildID_campaignID_sessionID/userID.jsonl
+#Each line is one transcribed chunk: {"chunk": <chunk key>, "segments": [...]}
+TRANSCRIPTS_DIR = 'transcripts'
+#Working directories of a legacy transcript migration, next to the session directory
+MIGRATING_SUFFIX = '.migrating'
+BACKUP_SUFFIX = '.premigration'
+#One writer lock per session, only held while a chunk is written so transcriptions themselves can overlap
+session_locks = {}
+#Per user log: chunk keys already written, and how far into the file (and which file) they were read from.
+#Other processes append too, so this only saves rereading the part of the log already seen.
+recorded_chunks = {}
+
+def session_dir(guild_id, campaign_id, session_number):
+    return os.path.join(TRANSCRIPTS_DIR, f'{guild_id}_{campaign_id}_{session_number}')
+
+def legacy_transcript_path(guild_id, campaign_id, session_number):
+    return os.path.join(TRANSCRIPTS_DIR, f'{guild_id}_{campaign_id}_{session_number}.json')
+
+def session_lock(guild_id, campaign_id, session_number):
+    return session_locks.setdefault(session_dir(guild_id, campaign_id, session_number), asyncio.Lock())
+
+def user_path(guild_id, campaign_id, session_number, userID):
+    return os.path.join(session_dir(guild_id, campaign_id, session_number), f'{userID}.jsonl')
+
+@contextlib.contextmanager
+def store_lock(path):
+    #Exclusive lock on one session's store, shared by every process that writes to it: the bot and any worker.py.
+    #session_lock only orders writers inside one process. This blocks, so it is only taken on the offload thread pool.
+    with open(path, 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    #LK_LOCK gives up after about ten seconds of waiting
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def lock_path(guild_id, campaign_id, session_number):
+    #Beside the session directory rather than in it, so it stays put while a migration swaps the directory
+    return session_dir(guild_id, campaign_id, session_number) + '.lock'
+
+def write_chunk(lock, store, path, chunk, line):
+    #Runs on the offload thread pool. Under the store lock, lines other processes appended since this one last
+    #looked are read first, so the duplicate check covers every writer, then the line goes out in one write.
+    os.makedirs(TRANSCRIPTS_DIR, exist_ok=True)
+    with store_lock(lock):
+        seen = recorded_chunks.get(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        #Rewritten by a migration, possibly in another process, so everything is read again
+        if seen is None or stat is None or stat.st_ino != seen['inode'] or stat.st_size < seen['offset']:
+            seen = recorded_chunks[path] = {'chunks': set(), 'offset': 0, 'inode': None}
+        torn = False
+        if stat is not None:
+            with open(path, 'rb') as file:
+                file.seek(seen['offset'])
+                for raw in file:
+                    #A writer that died mid-line leaves it without a newline; it is closed off before appending
+                    torn = not raw.endswith(b'\n')
+                    if raw.strip():
+                        try:
+                            seen['chunks'].add(json.loads(raw)['chunk'])
+                        except ValueError:
+                            pass
+                seen['offset'] = file.tell()
+                seen['inode'] = stat.st_ino
+        if chunk in seen['chunks']:
+            return False
+        os.makedirs(store, exist_ok=True)
+        with open(path, 'ab') as file:
+            file.write((('\n' if torn else '') + line).encode())
+            file.flush()
+            seen['offset'] = file.tell()
+            seen['inode'] = os.fstat(file.fileno()).st_ino
+        seen['chunks'].add(chunk)
+        return True
+
+async def append_chunk(guild_id, campaign_id, session_number, userID, chunk, segments):
+    #Returns False without writing if this user's chunk is already in the log
+    store = session_dir(guild_id, campaign_id, session_number)
+    path = user_path(guild_id, campaign_id, session_number, userID)
+    line = json.dumps({'chunk': chunk, 'segments': segments}) + '\n'
+    async with session_lock(guild_id, campaign_id, session_number):
+        return await offload.run_io(write_chunk, lock_path(guild_id, campaign_id, session_number), store, path, chunk, line)
+
+def list_users(guild_id, campaign_id, session_number):
+    store = session_dir(guild_id, campaign_id, session_number)
+    if not os.path.isdir(store):
+        return []
+    return [filename[:-len('.jsonl')] for filename in sorted(os.listdir(store)) if filename.endswith('.jsonl')]
+
+async def read_user_chunks(guild_id, campaign_id, session_number, userID):
+    #Streams (chunk, segments) for one user in time order, skipping repeated chunk keys.
+    #Chunks can be appended out of order (short chunks are held back and batched), so a first pass indexes
+    #each line's offset and start time and a second pass reads the lines back one at a time in that order.
+    seen = set()
+    index = []
+    async with aiofiles.open(user_path(guild_id, campaign_id, session_number, userID), 'rb') as file:
+        while True:
+            offset = await file.tell()
+            line = await file.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                #A writer that died mid-line, the chunk is transcribed again on resume
+                print(f"Skipping torn line at byte {offset} of {file.name}")
+                continue
+            if record['chunk'] in seen or not record['segments']:
+                continue
+            seen.add(record['chunk'])
+            index.append((record['segments'][0]['start_seconds'], len(index), offset))
+        for _, _, offset in sorted(index):
+            await file.seek(offset)
+            record = json.loads(await file.readline())
+            yield record['chunk'], record['segments']
+
+async def read_user_segments(guild_id, campaign_id, session_number, userID):
+    async for chunk, segments in read_user_chunks(guild_id, campaign_id, session_number, userID):
+        for segment in segments:
+            yield segment
+
+async def merge_session(guild_id, campaign_id, session_number):
+    #Streaming k-way merge of every user's segments by start time.
+    #Each user's chunks come back in time order, so only the current chunk per user is held in memory
+    streams = [(userID, read_user_segments(guild_id, campaign_id, session_number, userID)) for userID in list_users(guild_id, campaign_id, session_number)]
+    heap = []
+    for order, (userID, stream) in enumerate(streams):
+        segment = await anext(stream, None)
+        if segment is not None:
+            heap.append((segment['start_seconds'], order, segment))
+    heapq.heapify(heap)
+    while heap:
+        _, order, segment = heap[0]
+        userID, stream = streams[order]
+        yield userID, segment
+        following = await anext(stream, None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (following['start_seconds'], order, following))
+
+def convert_legacy_transcript(legacy_path, scratch):
+    #Writes one JSONL file per user into scratch, replacing anything already there
+    with open(legacy_path, 'r') as json_file:
+        all_transcripts = json.load(json_file)
+    os.makedirs(scratch, exist_ok=True)
+    for userID, user_transcripts in all_transcripts.items():
+        with open(os.path.join(scratch, f'{userID}.jsonl'), 'w') as file:
+            for index, segments in enumerate(user_transcripts):
+                file.write(json.dumps({'chunk': f'legacy_{index}', 'segments': segments}) + '\n')
+
+def append_logs(source, destination):
+    #Appends each user log in source to the same user's log in destination. Repeating this after a crash
+    #only duplicates lines, and readers skip a chunk key they have already seen
+    os.makedirs(destination, exist_ok=True)
+    for filename in os.listdir(source):
+        if filename.endswith('.jsonl'):
+            with open(os.path.join(source, filename), 'rb') as newer, open(os.path.join(destination, filename), 'a+b') as file:
+                #A torn last line is closed off first, so it doesn't swallow the first appended line
+                if file.tell() > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        file.write(b'\n')
+                shutil.copyfileobj(newer, file)
+
+def migrate_store(legacy_path, store, lock):
+    #Runs in the offload process pool, since parsing a whole legacy transcript holds the GIL for as long as it
+    #takes, with the store lock held against appends from any process. Each step can be repeated after a crash:
+    #  1. the current store (chunks recorded since the upgrade) is moved aside to .premigration
+    #  2. .migrating is rebuilt from the legacy file, and the moved-aside chunks are appended after it
+    #  3. the legacy file is renamed to .json.migrated; from here on .migrating holds the whole session
+    #  4. anything appended to a new store since a crash is added, and .migrating replaces the store
+    #  5. .premigration is deleted
+    #Returns True if the legacy file was converted.
+    scratch = store + MIGRATING_SUFFIX
+    backup = store + BACKUP_SUFFIX
+    converted = False
+    with store_lock(lock):
+        if os.path.exists(legacy_path):
+            if os.path.isdir(store):
+                if os.path.isdir(backup):
+                    append_logs(store, backup)
+                    shutil.rmtree(store)
+                else:
+                    os.replace(store, backup)
+            convert_legacy_transcript(legacy_path, scratch)
+            if os.path.isdir(backup):
+                append_logs(backup, scratch)
+            os.replace(legacy_path, legacy_path + '.migrated')
+            converted = True
+        if os.path.isdir(scratch):
+            if os.path.isdir(store):
+                append_logs(store, scratch)
+                shutil.rmtree(store)
+            os.replace(scratch, store)
+        if os.path.isdir(backup):
+            shutil.rmtree(backup)
+    return converted
+
+def forget_store(store):
+    for path in [path for path in recorded_chunks if os.path.dirname(path) == store]:
+        del recorded_chunks[path]
+
+def close_session(guild_id, campaign_id, session_number):
+    #Called once a session is merged, so the lock and cache of every finished session don't stay around for the
+    #life of the process. Both are recreated if the session is picked up again.
+    store = session_dir(guild_id, campaign_id, session_number)
+    lock = session_locks.get(store)
+    if lock is not None and not lock.locked():
+        del session_locks[store]
+    forget_store(store)
+
+async def migrate_legacy_transcript(guild_id, campaign_id, session_number):
+    #Converts an old single-file guildID_campaignID_sessionID.json transcript into the per-user JSONL layout,
+    #or finishes one a crash interrupted. The original file is kept alongside as .json.migrated
+    legacy_path = legacy_transcript_path(guild_id, campaign_id, session_number)
+    store = session_dir(guild_id, campaign_id, session_number)
+    if not any([await offload.exists(path) for path in (legacy_path, store + MIGRATING_SUFFIX, store + BACKUP_SUFFIX)]):
+        return False
+    async with session_lock(guild_id, campaign_id, session_number):
+        print(f"Migrating legacy transcript {legacy_path}")
+        converted = await offload.run_cpu(migrate_store, legacy_path, store, lock_path(guild_id, campaign_id, session_number))
+        forget_store(store)
+        return converted
+
+async def recover_migrations():
+    #Called on startup: rolls forward any migration a crash left half done
+    if not await offload.exists(TRANSCRIPTS_DIR):
+        return
+    stores = set()
+    for name in await offload.run_io(os.listdir, TRANSCRIPTS_DIR):
+        for suffix in (MIGRATING_SUFFIX, BACKUP_SUFFIX):
+            if name.endswith(suffix):
+                stores.add(name[:-len(suffix)])
+    for name in stores:
+        store = os.path.join(TRANSCRIPTS_DIR, name)
+        print(f"Finishing interrupted migration of {store}")
+        await offload.run_cpu(migrate_store, store + '.json', store, store + '.lock')
+        forget_store(store)
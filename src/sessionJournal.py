@@ -0,0 +1,112 @@
+import time
+import database
+
+#Pipeline stages, in order. Each chunk row moves forward through them, and a session's status is the
+#stage its whole transcript has reached, so anything short of SUMMARIZED still has work left after a restart.
+RECORDING = 'recording'
+RECORDED = 'recorded'
+TRANSCRIBED = 'transcribed'
+MERGED = 'merged'
+SUMMARIZED = 'summarized'
+#Sessions whose chunks held no speech at all, there is nothing to merge or summarize
+EMPTY = 'empty'
+STAGES = [RECORDED, TRANSCRIBED, MERGED, SUMMARIZED]
+
+class JournaledSession:
+    #Stand-in for a RecordingSession when finishing a session after a restart, carrying just what the
+    #transcription, merge and notes steps read
+    def __init__(self, journal, session_id, guild_id, campaign_id, session_number, session_start, status, channel_id):
+        self.journal = journal
+        self.session_id = session_id
+        self.guild_id = guild_id
+        self.campaign_id = campaign_id
+        self.session_number = session_number
+        self.session_start = session_start
+        self.status = status
+        self.channel_id = channel_id
+        self.summarizer = None
+
+class SessionJournal:
+    #Durable record in glyph_db.db of each session and every audio chunk it produced, with the pipeline stage
+    #each has reached. Writes are best effort: a failed journal write is logged and never stops a recording.
+    def __init__(self, db):
+        self.db = db
+
+    async def write(self, *statements):
+        try:
+            async with self.db.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    for query, params in statements:
+                        await cursor.execute(query, params)
+                await conn.commit()
+        except Exception as e:
+            print(f"Session journal write failed: {e}")
+
+    async def open_session(self, session, channel_id=None):
+        #Called each time recording starts, so a session picked up again after /stop is marked live again
+        try:
+            async with self.db.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    session.session_id = await database.ensure_session(cursor, session.guild_id, session.campaign_id, session.session_number, session.session_start)
+                    await cursor.execute(
+                        "UPDATE sessions SET status = ?, channel_id = COALESCE(?, channel_id), updated_at = ? WHERE session_id = ?",
+                        (RECORDING, channel_id, round(time.time()), session.session_id)
+                    )
+                await conn.commit()
+        except Exception as e:
+            print(f"Session journal write failed: {e}")
+
+    async def record_chunk(self, session, user_id, file_path, file_start, duration):
+        if session.session_id is None:
+            return
+        await self.write(('''
+            INSERT INTO chunks (session_id, user_id, file_path, file_start, duration, stage, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (session_id, file_path) DO UPDATE SET duration = excluded.duration
+        ''', (session.session_id, int(user_id), file_path, file_start, duration, RECORDED, round(time.time()))))
+
+    async def chunk_transcribed(self, session, file_path):
+        if session.session_id is None:
+            return
+        await self.write((
+            "UPDATE chunks SET stage = ?, updated_at = ? WHERE session_id = ? AND file_path = ? AND stage = ?",
+            (TRANSCRIBED, round(time.time()), session.session_id, file_path, RECORDED)
+        ))
+
+    async def advance(self, session, stage):
+        #Moves the session to `stage`, along with every chunk that had reached the stage before it
+        if session.session_id is None:
+            return
+        now = round(time.time())
+        statements = [("UPDATE sessions SET status = ?, updated_at = ? WHERE session_id = ?", (stage, now, session.session_id))]
+        if stage in STAGES[1:]:
+            statements.append((
+                "UPDATE chunks SET stage = ?, updated_at = ? WHERE session_id = ? AND stage = ?",
+                (stage, now, session.session_id, STAGES[STAGES.index(stage) - 1])
+            ))
+        await self.write(*statements)
+
+    async def unfinished_sessions(self):
+        #Sessions with journaled chunks that never got as far as notes, and finished sessions with chunks whose
+        #transcription failed, which are retried and the notes redone
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT session_id, guild_id, campaign_id, session_number, session_start, status, channel_id
+                    FROM sessions s
+                    WHERE (status NOT IN (?, ?) AND EXISTS (SELECT 1 FROM chunks c WHERE c.session_id = s.session_id))
+                    OR EXISTS (SELECT 1 FROM chunks c WHERE c.session_id = s.session_id AND c.stage = ?)
+                ''', (SUMMARIZED, EMPTY, RECORDED))
+                rows = await cursor.fetchall()
+        return [JournaledSession(self, *row) for row in rows]
+
+    async def pending_chunks(self, session):
+        #Chunks that were recorded but never transcribed, in transcribe_files form
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT user_id, file_path, file_start, duration FROM chunks WHERE session_id = ? AND stage = ? ORDER BY file_start",
+                    (session.session_id, RECORDED)
+                )
+                rows = await cursor.fetchall()
+        return [{'file': file_path, 'userID': user_id, 'start': file_start, 'duration': duration} for user_id, file_path, file_start, duration in rows]
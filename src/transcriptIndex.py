@@ -0,0 +1,65 @@
+import database
+
+#Merged segments are written to the segments table, and through its triggers to segments_fts, in batches of this many
+INDEX_BATCH = 500
+
+class SegmentIndexer:
+    #Collects the search index rows for one session while combine_transcripts streams its merged segments, then
+    #writes them once the merge is done. Any rows from an earlier combine of the same session are replaced in the
+    #same short transaction, so search never sees a half indexed session and other writers are only held up
+    #for the write itself, not the whole merge.
+    def __init__(self, db, guild_id, campaign_id, session_number, session_start=None):
+        self.db = db
+        self.guild_id = guild_id
+        self.campaign_id = campaign_id
+        self.session_number = session_number
+        self.session_start = session_start
+        self.rows = []
+
+    def add(self, user_id, speaker, segment):
+        self.rows.append((int(user_id), speaker, segment['start_seconds'], segment['end_seconds'], segment['text'].strip()))
+
+    async def write(self):
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                #asqlite connections autocommit, so the transaction is opened explicitly
+                await cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    session_id = await database.ensure_session(cursor, self.guild_id, self.campaign_id, self.session_number, self.session_start)
+                    await cursor.execute("DELETE FROM segments WHERE session_id = ?", (session_id,))
+                    for index in range(0, len(self.rows), INDEX_BATCH):
+                        await cursor.executemany(
+                            "INSERT INTO segments (session_id, user_id, speaker, start_seconds, end_seconds, text) VALUES (?, ?, ?, ?, ?, ?)",
+                            [(session_id, *row) for row in self.rows[index:index + INDEX_BATCH]]
+                        )
+                except BaseException:
+                    await conn.rollback()
+                    raise
+            await conn.commit()
+        print(f"Indexed {len(self.rows)} segments for session {self.session_number}")
+
+def match_query(text):
+    #Quotes every word so user input can't break FTS5 query syntax
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+async def search(db, guild_id, text, campaign_id=None, limit=10):
+    #Best bm25 matches in this guild, optionally within one campaign
+    query = '''
+        SELECT c.campaign_name, se.session_number, s.speaker, s.start_seconds,
+               snippet(segments_fts, 0, '**', '**', '...', 16) AS excerpt
+        FROM segments_fts
+        JOIN segments s ON s.segment_id = segments_fts.rowid
+        JOIN sessions se ON se.session_id = s.session_id
+        JOIN campaigns c ON c.campaign_id = se.campaign_id
+        WHERE segments_fts MATCH ? AND se.guild_id = ?
+    '''
+    params = [match_query(text), guild_id]
+    if campaign_id is not None:
+        query += ' AND se.campaign_id = ?'
+        params.append(campaign_id)
+    query += ' ORDER BY bm25(segments_fts) LIMIT ?'
+    params.append(limit)
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(query, tuple(params))
+            return await cursor.fetchall()
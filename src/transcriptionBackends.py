@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+from concurrent.futures import ProcessPoolExecutor
+import offload
+from openaiScheduler import LIVE
+
+#Every backend returns segments as [{'start', 'end', 'text'}] with times relative to the start of the file,
+#or None if the file could not be transcribed. Whisper backends add 'no_speech_prob' and 'avg_logprob', which
+#compaction uses to tell a hallucinated "you" on silence from a real one.
+SEGMENT_SCORES = ('no_speech_prob', 'avg_logprob')
+
+class TranscriptionBackend:
+    name = 'base'
+
+    def cache_params(self):
+        #Anything that changes the output for the same audio, folded into the Whisper cache key
+        return {'backend': self.name}
+
+    async def transcribe(self, file_path, priority=LIVE):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def segment_field(segment, name, default=None):
+    #Older SDK versions hand back verbose_json segments as dicts, newer ones as objects
+    return segment.get(name, default) if isinstance(segment, dict) else getattr(segment, name, default)
+
+def whisper_segment(segment):
+    result = {'start': segment_field(segment, 'start'), 'end': segment_field(segment, 'end'), 'text': segment_field(segment, 'text')}
+    for name in SEGMENT_SCORES:
+        value = segment_field(segment, name)
+        if value is not None:
+            result[name] = value
+    return result
+
+class OpenAIBackend(TranscriptionBackend):
+    name = 'openai'
+
+    def __init__(self, client, scheduler, params):
+        self.client = client
+        self.scheduler = scheduler
+        self.params = params
+
+    def cache_params(self):
+        return {'backend': self.name, **self.params}
+
+    async def transcribe(self, file_path, priority=LIVE):
+        #Read once off the event loop; every attempt uploads the same bytes
+        audio = await offload.read_bytes(file_path)
+        async def upload():
+            return await self.client.audio.transcriptions.create(file=(os.path.basename(file_path), audio), **self.params)
+        transcript = await self.scheduler.run('whisper', upload, priority)
+        if transcript is None:
+            return None
+        print(transcript)
+        return [whisper_segment(segment) for segment in transcript.segments]
+
+#Loaded once per worker process by _local_transcribe
+_local_model = None
+
+def _local_transcribe(model_size, compute_type, file_path, language, prompt):
+    global _local_model
+    from faster_whisper import WhisperModel
+    if _local_model is None:
+        _local_model = WhisperModel(model_size, device='cpu', compute_type=compute_type)
+    segments, _ = _local_model.transcribe(file_path, language=language, initial_prompt=prompt)
+    return [whisper_segment(segment) for segment in segments]
+
+class LocalWhisperBackend(TranscriptionBackend):
+    #Runs faster-whisper on the CPU in a pool of worker processes, each holding its own copy of the model
+    name = 'local'
+
+    def __init__(self, model_size='small', workers=2, compute_type='int8', language='en', prompt=None):
+        if importlib.util.find_spec('faster_whisper') is None:
+            raise RuntimeError("The local transcription backend needs faster-whisper: pip install faster-whisper")
+        self.model_size = model_size
+        self.compute_type = compute_type
+        self.language = language
+        self.prompt = prompt
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def cache_params(self):
+        return {'backend': self.name, 'model': self.model_size, 'compute_type': self.compute_type, 'language': self.language, 'prompt': self.prompt}
+
+    async def transcribe(self, file_path, priority=LIVE):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _local_transcribe, self.model_size, self.compute_type, os.path.abspath(file_path), self.language, self.prompt)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class FakeBackend(TranscriptionBackend):
+    #Deterministic stand-in for tests and offline load runs. The same file content always gives the same
+    #segments, and `latency` seconds are waited per request to imitate a remote call.
+    name = 'fake'
+
+    def __init__(self, latency=0.0, segment_seconds=4.0):
+        self.latency = latency
+        self.segment_seconds = segment_seconds
+
+    def cache_params(self):
+        return {'backend': self.name, 'segment_seconds': self.segment_seconds}
+
+    async def transcribe(self, file_path, priority=LIVE):
+        digest = hashlib.sha256(await offload.read_bytes(file_path)).hexdigest()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        count = 1 + int(digest[:2], 16) % 4
+        return [
+            {'start': index * self.segment_seconds, 'end': (index + 1) * self.segment_seconds - 0.5, 'text': f" Fake segment {index + 1} of {digest[:8]}."}
+            for index in range(count)
+        ]
+
+def create_backend(settings, client, scheduler, whisper_params):
+    #settings is config 'transcription_backend': {'type': 'openai' | 'local' | 'fake', ...options}
+    backend_type = settings.get('type', 'openai')
+    if backend_type == 'openai':
+        return OpenAIBackend(client, scheduler, whisper_params)
+    if backend_type == 'local':
+        return LocalWhisperBackend(
+            model_size=settings.get('model', 'small'),
+            workers=settings.get('workers', 2),
+            compute_type=settings.get('compute_type', 'int8'),
+            language=whisper_params.get('language'),
+            prompt=whisper_params.get('prompt')
+        )
+    if backend_type == 'fake':
+        return FakeBackend(latency=settings.get('latency', 0.0), segment_seconds=settings.get('segment_seconds', 4.0))
+    raise ValueError(f"Unknown transcription backend {backend_type}")
@@ -0,0 +1,148 @@
+import asyncio
+import time
+import apiClient
+import jobQueue
+import metrics
+
+def session_key(session):
+    return (session.guild_id, session.campaign_id, session.session_number)
+
+def failed_result(job):
+    return {'file': job.file_path, 'userID': job.userID, 'start': job.fileStart, 'status': 'failed', 'segments': None}
+
+class TranscriptionJob:
+    def __init__(self, file_path, userID, session, fileStart, duration=None):
+        self.file_path = file_path
+        self.userID = userID
+        self.session = session
+        self.fileStart = fileStart
+        self.duration = duration
+        #Set once a worker has taken the job, on its own or along with an earlier chunk of the same speaker
+        self.claimed = False
+        self.enqueued_at = time.time()
+        self.future = asyncio.get_running_loop().create_future()
+
+class TranscriptionQueue:
+    #Long-lived worker tasks that transcribe rotated chunks in the background.
+    #Jobs for the same user run one at a time. A short chunk takes the same user's other short chunks still waiting
+    #in the queue along with it, and transcribe_files sends them as one upload (see apiClient.plan_batches).
+    def __init__(self, workers=None):
+        self.worker_count = workers or apiClient.config.get('transcription_workers', 2)
+        self.queue = asyncio.Queue()
+        self.workers = []
+        self.unfinished = {}
+        self.user_locks = {}
+
+    def start(self):
+        for index in range(self.worker_count):
+            self.workers.append(asyncio.create_task(self.worker(), name=f"transcription-worker-{index}"))
+        print(f"Started {self.worker_count} transcription workers")
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+    def enqueue(self, file_path, userID, session, fileStart, duration=None):
+        job = TranscriptionJob(file_path, userID, session, fileStart, duration)
+        self.unfinished.setdefault(session_key(session), []).append(job)
+        self.queue.put_nowait(job)
+        print(f"Queued {file_path} for transcription, queue depth {self.depth}")
+        return job
+
+    @property
+    def depth(self):
+        return sum(len(jobs) for jobs in self.unfinished.values())
+
+    @property
+    def lag(self):
+        #Seconds the oldest unfinished chunk has been waiting since its audio was closed
+        oldest = min((job.enqueued_at for jobs in self.unfinished.values() for job in jobs), default=None)
+        return 0 if oldest is None else time.time() - oldest
+
+    async def drain(self, session):
+        #Waits for every queued chunk of this session and returns their per-file results
+        jobs = list(self.unfinished.get(session_key(session), []))
+        return await asyncio.gather(*(job.future for job in jobs))
+
+    @staticmethod
+    def is_short(job):
+        return job.duration is not None and job.duration < apiClient.BATCH_MAX_CHUNK_SECONDS
+
+    def claim_batch(self, job):
+        #Called holding the user's lock: the job plus the same user's short chunks nobody has taken yet, up to one upload
+        batch = [job]
+        if not self.is_short(job):
+            return batch
+        seconds = job.duration + apiClient.BATCH_GAP_SECONDS
+        for other in self.unfinished.get(session_key(job.session), []):
+            if other.claimed or str(other.userID) != str(job.userID) or not self.is_short(other):
+                continue
+            if seconds + other.duration + apiClient.BATCH_GAP_SECONDS > apiClient.BATCH_MAX_SECONDS:
+                break
+            other.claimed = True
+            seconds += other.duration + apiClient.BATCH_GAP_SECONDS
+            batch.append(other)
+        return batch
+
+    @staticmethod
+    def files(batch):
+        return [{'file': job.file_path, 'userID': job.userID, 'start': job.fileStart, 'duration': job.duration} for job in batch]
+
+    async def transcribe(self, batch):
+        #Returns per-file results in transcribe_files form
+        return await apiClient.transcribe_files(self.files(batch), batch[0].session, apiClient.LIVE)
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job.claimed:
+                #Already transcribed along with an earlier chunk
+                self.queue.task_done()
+                continue
+            job.claimed = True
+            batch = [job]
+            lock_key = (session_key(job.session), str(job.userID))
+            lock = self.user_locks.setdefault(lock_key, asyncio.Lock())
+            try:
+                async with lock:
+                    batch = self.claim_batch(job)
+                    results = {result['file']: result for result in await self.transcribe(batch)}
+                    for each in batch:
+                        each.future.set_result(results.get(each.file_path) or failed_result(each))
+            except Exception as e:
+                print(f"Transcription worker failed on {job.file_path}: {e}")
+                for each in batch:
+                    if not each.future.done():
+                        each.future.set_result(failed_result(each))
+                        metrics.transcription_results.inc(status='failed')
+            finally:
+                jobs = self.unfinished.get(session_key(job.session), [])
+                for each in batch:
+                    if not each.future.done():
+                        each.future.cancel()
+                    if each in jobs:
+                        jobs.remove(each)
+                #Anything waiting on or about to take this user's lock is still unfinished, so with none left it can go
+                if not any(str(other.userID) == lock_key[1] for other in jobs):
+                    self.user_locks.pop(lock_key, None)
+                if not jobs:
+                    self.unfinished.pop(session_key(job.session), None)
+                self.queue.task_done()
+
+class ExternalTranscriptionQueue(TranscriptionQueue):
+    #Hands each chunk to the worker.py processes through the durable job queue instead of transcribing it here.
+    #The local workers only submit jobs and wait for them, so there are many more of them.
+    def __init__(self, jobs, workers=None):
+        super().__init__(workers or apiClient.config.get('external_transcription_inflight', 32))
+        self.jobs = jobs
+
+    async def transcribe(self, batch):
+        files = self.files(batch)
+        results = await self.jobs.run('transcribe', {'session': jobQueue.session_payload(batch[0].session), 'files': files, 'priority': apiClient.LIVE},
+                                      apiClient.LIVE, dedupe_key='transcribe:' + ','.join(each['file'] for each in files))
+        #The worker process counted these in its own metrics
+        for result in results:
+            metrics.transcription_results.inc(status=result['status'])
+        return results
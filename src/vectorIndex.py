@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import aiofiles
+import apiClient
+import offload
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#One index per campaign: a .npy file holds unit-length float32 rows and the matching .jsonl holds one metadata line
+#per row. The .npy file is memory-mapped on load. Windows can't replace or delete a file while it is mapped, so
+#every write goes to new files, and vectors/guildID_campaignID.json names the current pair.
+VECTORS_DIR = 'vectors'
+EMBEDDING_SETTINGS = {'type': 'openai', 'model': 'text-embedding-3-small', 'batch_size': 256, **apiClient.config.get('embedding', {})}
+#Queries are scored against this many index rows at a time, so only a block of the mapped file is in memory at once
+SCORE_BLOCK_ROWS = 16384
+#Transcript windows span up to this many seconds of conversation
+WINDOW_SECONDS = EMBEDDING_SETTINGS.get('window_seconds', 90)
+ASK_PROMPT = "You answer questions about a Dungeons and Dragons campaign using excerpts from session transcripts and session notes. Use only the excerpts. Mention the session and time when it helps, and say so if the excerpts don't contain the answer."
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("The vector index needs numpy: pip install numpy")
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+class OpenAIEmbedder:
+    def __init__(self, model, batch_size):
+        self.name = f'openai:{model}'
+        self.model = model
+        self.batch_size = batch_size
+
+    async def embed(self, texts, priority=apiClient.BACKGROUND):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            response = await apiClient.scheduler.run('embedding', lambda: apiClient.client.embeddings.create(model=self.model, input=batch), priority)
+            vectors.extend(item.embedding for item in response.data)
+        return normalize(np.array(vectors, dtype=np.float32))
+
+class HashingEmbedder:
+    #Local, deterministic bag-of-words embedding (signed feature hashing). Needs no network, so it works for
+    #offline tests and for deployments that don't want to send transcripts out for embedding.
+    def __init__(self, dimensions=512):
+        self.name = f'hashing:{dimensions}'
+        self.dimensions = dimensions
+
+    async def embed(self, texts, priority=apiClient.BACKGROUND):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"[a-z0-9']+", text.lower()):
+                digest = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+                vectors[row, digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+        return normalize(vectors)
+
+def create_embedder(settings):
+    if settings['type'] == 'openai':
+        return OpenAIEmbedder(settings['model'], settings['batch_size'])
+    if settings['type'] == 'hashing':
+        return HashingEmbedder(settings.get('dimensions', 512))
+    raise ValueError(f"Unknown embedder {settings['type']}")
+
+embedder = create_embedder(EMBEDDING_SETTINGS)
+
+def index_base(guild_id, campaign_id):
+    return os.path.join(VECTORS_DIR, f'{guild_id}_{campaign_id}')
+
+def index_paths(guild_id, campaign_id):
+    #(vector_path, meta_path) of the campaign's current index, or None if it has none
+    base = index_base(guild_id, campaign_id)
+    try:
+        with open(f'{base}.json', 'r') as pointer_file:
+            current = json.load(pointer_file)
+        return os.path.join(VECTORS_DIR, current['vectors']), os.path.join(VECTORS_DIR, current['metadata'])
+    except FileNotFoundError:
+        pass
+    #Written before the index files were versioned
+    if os.path.exists(f'{base}.npy') and os.path.exists(f'{base}.jsonl'):
+        return f'{base}.npy', f'{base}.jsonl'
+    return None
+
+#index base -> (vector_path, vectors, metadata), so repeated queries reuse the mapping until the index is rewritten
+loaded_indexes = {}
+#Per offload process: index base -> (vector_path, vectors), the memory-mapped index score_index reads
+mapped_vectors = {}
+#One lock per campaign index. Indexing reads, extends and rewrites the whole file, so two sessions indexed at
+#once (a /done alongside reindexTranscripts) would otherwise each drop the other's entries.
+index_locks = {}
+
+def index_lock(guild_id, campaign_id):
+    return index_locks.setdefault((guild_id, campaign_id), asyncio.Lock())
+
+def load_index(guild_id, campaign_id):
+    #Returns (vectors, metadata, vector_path). Called with the campaign's index lock held
+    require_numpy()
+    base = index_base(guild_id, campaign_id)
+    paths = index_paths(guild_id, campaign_id)
+    if paths is None:
+        return None, [], None
+    vector_path, meta_path = paths
+    cached = loaded_indexes.get(base)
+    if cached is not None and cached[0] == vector_path:
+        return cached[1], cached[2], vector_path
+    #The old mapping is dropped first so its file can be deleted
+    loaded_indexes.pop(base, None)
+    vectors = np.load(vector_path, mmap_mode='r')
+    with open(meta_path, 'r') as meta_file:
+        metadata = [json.loads(line) for line in meta_file if line.strip()]
+    loaded_indexes[base] = (vector_path, vectors, metadata)
+    return vectors, metadata, vector_path
+
+def score_index(base, vector_path, query_vectors, k):
+    #Runs in the offload process pool against the memory-mapped index, scoring a block of rows at a time so the
+    #index is never read into memory whole. Returns [(score, row)] lists, or None if the index was rewritten
+    #and vector_path deleted since the caller read the metadata.
+    cached = mapped_vectors.get(base)
+    if cached is None or cached[0] != vector_path:
+        mapped_vectors.pop(base, None)
+        try:
+            vectors = np.load(vector_path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        cached = mapped_vectors[base] = (vector_path, vectors)
+    vectors = cached[1]
+    scores = np.empty((len(query_vectors), len(vectors)), dtype=np.float32)
+    for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+        scores[:, start:start + SCORE_BLOCK_ROWS] = query_vectors @ vectors[start:start + SCORE_BLOCK_ROWS].T
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    results = []
+    for row, candidates in enumerate(top):
+        ordered = candidates[np.argsort(-scores[row, candidates])]
+        results.append([(float(scores[row, index]), int(index)) for index in ordered])
+    return results
+
+def transcript_windows(sorted_path, session_number, window_seconds):
+    #Runs in the offload process pool, since parsing a whole _sorted.json holds the GIL for as long as it takes
+    with open(sorted_path, 'r') as sorted_file:
+        segments = json.load(sorted_file)
+    entries = []
+    window = []
+    for segment in segments + [None]:
+        if window and (segment is None or segment['start_seconds'] - window[0]['start_seconds'] > window_seconds):
+            text = '\n'.join(f"{item['name']}:{item['text']}" for item in window)
+            entries.append((text, {'kind': 'transcript', 'session_number': session_number, 'start_seconds': window[0]['start_seconds'], 'text': text}))
+            window = []
+        if segment is not None:
+            window.append(segment)
+    return entries
+
+def write_index(base, vectors, metadata):
+    #Writes a new pair of index files, points base.json at them, then deletes the older ones. A file still mapped
+    #somewhere can't be deleted on Windows; it is tried again on the next write.
+    os.makedirs(VECTORS_DIR, exist_ok=True)
+    name = f'{os.path.basename(base)}.{time.time_ns()}'
+    with open(os.path.join(VECTORS_DIR, f'{name}.npy'), 'wb') as vector_file:
+        np.save(vector_file, vectors)
+    with open(os.path.join(VECTORS_DIR, f'{name}.jsonl'), 'w') as meta_file:
+        meta_file.write(''.join(json.dumps(meta) + '\n' for meta in metadata))
+    with open(f'{base}.json.tmp', 'w') as pointer_file:
+        json.dump({'vectors': f'{name}.npy', 'metadata': f'{name}.jsonl'}, pointer_file)
+    os.replace(f'{base}.json.tmp', f'{base}.json')
+    prefix = os.path.basename(base) + '.'
+    for filename in os.listdir(VECTORS_DIR):
+        if filename.startswith(prefix) and filename.endswith(('.npy', '.jsonl')) and not filename.startswith(name + '.'):
+            try:
+                os.remove(os.path.join(VECTORS_DIR, filename))
+            except OSError:
+                pass
+
+async def session_entries(guild_id, campaign_id, session_number):
+    #Transcript windows from _sorted.json and paragraphs from _summary.txt, as (text, metadata) pairs
+    entries = []
+    sorted_path = f'transcripts/{guild_id}_{campaign_id}_{session_number}_sorted.json'
+    if await offload.exists(sorted_path):
+        entries.extend(await offload.run_cpu(transcript_windows, sorted_path, session_number, WINDOW_SECONDS))
+    summary_path = f'notes/{guild_id}_{campaign_id}_{session_number}_summary.txt'
+    if await offload.exists(summary_path):
+        async with aiofiles.open(summary_path, 'r') as summary_file:
+            summary = await summary_file.read()
+        for paragraph in re.split(r'\n\s*\n', summary):
+            if paragraph.strip():
+                entries.append((paragraph.strip(), {'kind': 'summary', 'session_number': session_number, 'start_seconds': None, 'text': paragraph.strip()}))
+    return entries
+
+async def index_session(guild_id, campaign_id, session_number):
+    #Adds (or replaces) one session's windows and summary in the campaign index
+    require_numpy()
+    entries = await session_entries(guild_id, campaign_id, session_number)
+    #Embedded before taking the lock, which only covers the read-modify-write of the index files
+    new_vectors = await embedder.embed([text for text, _ in entries]) if entries else None
+    async with index_lock(guild_id, campaign_id):
+        vectors, metadata, _ = await offload.run_io(load_index, guild_id, campaign_id)
+        keep = [index for index, meta in enumerate(metadata) if meta['session_number'] != session_number and meta.get('embedder') == embedder.name]
+        parts = []
+        if keep:
+            parts.append(np.asarray(vectors[keep]))
+        if new_vectors is not None:
+            parts.append(new_vectors)
+        if not parts:
+            return 0
+        combined = np.concatenate(parts)
+        combined_meta = [metadata[index] for index in keep] + [{**meta, 'embedder': embedder.name} for _, meta in entries]
+        #Nothing here may still map the old file when write_index deletes it
+        base = index_base(guild_id, campaign_id)
+        vectors = parts = None
+        loaded_indexes.pop(base, None)
+        await offload.run_io(write_index, base, combined, combined_meta)
+    print(f"Vector index for campaign {campaign_id} now holds {len(combined_meta)} entries")
+    return len(entries)
+
+async def search(guild_id, campaign_id, queries, k=8):
+    #Top-k entries for each query, as [(score, metadata)] lists in the same order as queries
+    base = index_base(guild_id, campaign_id)
+    query_vectors = None
+    #A rewrite landing between loading the metadata and scoring is retried against the new index
+    for attempt in range(3):
+        async with index_lock(guild_id, campaign_id):
+            vectors, metadata, vector_path = await offload.run_io(load_index, guild_id, campaign_id)
+        if vectors is None or not metadata:
+            return [[] for _ in queries]
+        if query_vectors is None:
+            query_vectors = await embedder.embed(queries, apiClient.NOTES)
+        ranked = await offload.run_cpu(score_index, base, vector_path, query_vectors, k)
+        if ranked is not None:
+            return [[(score, metadata[index]) for score, index in hits if index < len(metadata)] for hits in ranked]
+    raise RuntimeError(f"Vector index for campaign {campaign_id} kept changing during the search")
+
+async def answer(guild_id, campaign_id, question, k=8):
+    #Retrieval-augmented answer: only the best matching excerpts are sent to the chat model
+    hits = (await search(guild_id, campaign_id, [question], k))[0]
+    if not hits:
+        return None
+    excerpts = []
+    for _, meta in sorted(hits, key=lambda hit: (hit[1]['session_number'], hit[1]['start_seconds'] or 0)):
+        when = f"session {meta['session_number']}" + (f" at {apiClient.seconds_to_hhmm(meta['start_seconds'])}" if meta['start_seconds'] is not None else " notes")
+        excerpts.append(f"[{when}]\n{meta['text']}")
+    return await apiClient.complete_notes(ASK_PROMPT, '\n\n'.join(excerpts) + f"\n\nQuestion: {question}")
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import uuid
+import aiofiles
+import metrics
+import offload
+
+#Eviction removes least recently used entries until the cache is back under this share of max_bytes, so a full
+#cache isn't rescanned on every write
+EVICT_TO = 0.9
+
+class WhisperCache:
+    #Transcription results on disk, keyed by a hash of the audio content and the request parameters.
+    #Entries are touched on every hit. Writes add up the bytes written, and once that puts the cache over max_bytes
+    #the least recently used entries are removed.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        #Unknown until the first eviction scan, other processes writing to the same directory are only seen by a scan
+        self.total_bytes = None
+        self.evicting = False
+
+    def key_for(self, file_path, params):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as audio_file:
+            for block in iter(lambda: audio_file.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    async def get(self, key):
+        path = self.path_for(key)
+        if not await offload.exists(path):
+            metrics.whisper_cache_lookups.inc(result='miss')
+            return None
+        try:
+            async with aiofiles.open(path, 'r') as cache_file:
+                segments = json.loads(await cache_file.read())
+            await offload.run_io(os.utime, path)
+        except (OSError, ValueError) as e:
+            print(f"Dropping unreadable cache entry {path}: {e}")
+            await offload.remove(path)
+            metrics.whisper_cache_lookups.inc(result='miss')
+            return None
+        metrics.whisper_cache_lookups.inc(result='hit')
+        return segments
+
+    async def put(self, key, segments):
+        #The transcription already succeeded, so a failed cache write is only logged
+        path = self.path_for(key)
+        #Unique per writer, two workers can finish the same audio at once
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            data = json.dumps(segments)
+            await offload.makedirs(self.directory)
+            async with aiofiles.open(temp_path, 'w') as cache_file:
+                await cache_file.write(data)
+            await offload.replace(temp_path, path)
+        except Exception as e:
+            print(f"Could not write cache entry {path}: {e}")
+            try:
+                await offload.remove(temp_path)
+            except OSError:
+                pass
+            return
+        if self.total_bytes is not None:
+            self.total_bytes += len(data)
+        if (self.total_bytes is None or self.total_bytes > self.max_bytes) and not self.evicting:
+            self.evicting = True
+            try:
+                #A stat of every entry, so it runs off the event loop
+                self.total_bytes = await offload.run_io(self.evict)
+            except Exception as e:
+                print(f"Whisper cache eviction failed: {e}")
+            finally:
+                self.evicting = False
+
+    def evict(self):
+        #Returns the cache size left. Entries can vanish under the scan when another process evicts too
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return total
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
@@ -0,0 +1,99 @@
+#Out-of-process pipeline worker for worker_mode 'external'. Claims transcription, merge and notes jobs from
+#the durable job queue (jobQueue.py) and runs them with the same code the bot runs inline. Start as many as
+#the load needs on the bot's machine, from src/ so config.json is found. Only the same machine: the queue and the
+#database are SQLite in WAL mode, whose shared-memory index doesn't work over a network filesystem.
+#  python worker.py --concurrency 4
+import argparse
+import asyncio
+import os
+import socket
+import time
+from types import SimpleNamespace
+import asqlite
+import apiClient
+import database
+import jobQueue
+import offload
+import compaction
+from sessionJournal import SessionJournal, JournaledSession
+from cogs.recorder import combine_transcripts
+
+#How often each worker looks for jobs whose worker died, in seconds
+STALE_SWEEP_SECONDS = 60
+
+def session_from(payload, journal):
+    return JournaledSession(journal, payload['session_id'], payload['guild_id'], payload['campaign_id'],
+                            payload['session_number'], payload['session_start'], None, None)
+
+async def handle(context, kind, payload):
+    session = session_from(payload['session'], context.journal)
+    if kind == 'transcribe':
+        return await apiClient.transcribe_files(payload['files'], session, payload.get('priority', apiClient.LIVE))
+    if kind == 'combine':
+        result = await combine_transcripts(session=session, bot=context)
+        if result is None:
+            raise RuntimeError("Combining transcripts failed")
+        return result
+    if kind == 'notes':
+        notes = await apiClient.generate_notes(session=session)
+        if notes is None:
+            raise RuntimeError("Note generation failed")
+        return notes
+    raise ValueError(f"Unknown job kind {kind}")
+
+async def run_job(context, jobs, job_id, kind, payload):
+    print(f"Running {kind} job {job_id}")
+    try:
+        result = await handle(context, kind, payload)
+    except Exception as e:
+        print(f"{kind} job {job_id} failed: {e}")
+        await jobs.fail(job_id, e)
+        return
+    await jobs.complete(job_id, result)
+    print(f"Finished {kind} job {job_id}")
+
+async def main(args):
+    await offload.run_io(compaction.load_tokenizer)
+    jobs = await jobQueue.open_job_queue(apiClient.config.get('job_queue', {}))
+    db = await asqlite.create_pool('glyph_db.db', size=apiClient.config.get('db_pool_size', 5), init=database.configure_connection)
+    #combine_transcripts reads the campaign's names from context.db when there is no roster cache
+    context = SimpleNamespace(db=db, journal=SessionJournal(db))
+    worker_id = args.id or f"{socket.gethostname()}:{os.getpid()}"
+    slots = asyncio.Semaphore(args.concurrency)
+    running = set()
+    last_sweep = 0
+    print(f"Worker {worker_id} waiting for {', '.join(args.kinds) if args.kinds else 'all'} jobs")
+    try:
+        while True:
+            if time.monotonic() - last_sweep >= STALE_SWEEP_SECONDS:
+                last_sweep = time.monotonic()
+                requeued = await jobs.requeue_stale()
+                if requeued:
+                    print(f"Requeued {requeued} jobs from unresponsive workers")
+            await slots.acquire()
+            job = await jobs.claim(worker_id, args.kinds)
+            if job is None:
+                slots.release()
+                await asyncio.sleep(jobs.poll_interval)
+                continue
+            task = asyncio.create_task(run_job(context, jobs, *job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        await jobs.close()
+        await db.close()
+        offload.shutdown()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Glyph pipeline worker")
+    parser.add_argument('--id', help="name recorded on claimed jobs, defaults to host:pid")
+    parser.add_argument('--concurrency', type=int, default=apiClient.config.get('worker_concurrency', 4))
+    parser.add_argument('--kinds', nargs='*', choices=['transcribe', 'combine', 'notes'], help="only take these job kinds")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,56 @@
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import compaction
+
+@pytest.mark.parametrize('text', [
+    "I rolled a 6, 6 and a 2.",
+    "That's 20 20 damage",
+    "Roll 3 3 3 times",
+    "He had had enough.",
+    "Bye-bye",
+    "Uh-huh.",
+    "So... something happened.",
+])
+def test_content_is_kept(text):
+    assert compaction.clean_text(text) == text
+
+@pytest.mark.parametrize('text, expected', [
+    ("I-I think so.", "I think so."),
+    ("w-we should go", "we should go"),
+    ("I- I- I attack the goblin.", "I attack the goblin."),
+    ("We... we run.", "We run."),
+    ("the the the goblin", "the goblin"),
+    ("No, no, no, no!", "No!"),
+])
+def test_stutters_are_collapsed(text, expected):
+    assert compaction.clean_text(text) == expected
+
+@pytest.mark.parametrize('text, expected', [
+    (" Um, I think, uh, we should go.", "I think, we should go."),
+    (" It was, like, huge, you know, really.", "It was, huge, really."),
+    (" Hmm.", ""),
+    (" Thank you for watching!", ""),
+])
+def test_fillers_and_hallucinations(text, expected):
+    assert compaction.clean_text(text) == expected
+
+def test_compact_merges_speakers_and_marks_minutes():
+    segments = [
+        ('Aria', 0, 3, ' Um, hello.'),
+        ('Aria', 4, 7, ' We go north.'),
+        ('Bram', 8, 9, ' I follow.'),
+        ('Aria', 61, 64, ' Okay, so the door.'),
+    ]
+    assert compaction.compact(segments) == "[00:00]\nAria: Hello. We go north.\nBram: I follow.\n[00:01]\nAria: Okay, so the door.\n"
+
+def test_you_is_only_dropped_on_silence():
+    assert compaction.clean_text(" You.") == "You."
+    assert compaction.clean_text(" You.", compaction.likely_silence({'no_speech_prob': 0.05, 'avg_logprob': -0.3})) == "You."
+    assert compaction.clean_text(" You.", compaction.likely_silence({'no_speech_prob': 0.9, 'avg_logprob': -0.3})) == ""
+    assert compaction.clean_text(" You.", compaction.likely_silence({'no_speech_prob': 0.1, 'avg_logprob': -1.4})) == ""
+
+def test_token_estimate_without_tokenizer():
+    assert compaction.encoding is None
+    assert compaction.count_tokens("x" * 40) == 11
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import segmentStore
+
+SESSION = (1, 2, 3)
+
+def record(chunk, start):
+    return json.dumps({'chunk': chunk, 'segments': [{'start_seconds': start, 'end_seconds': start + 1, 'text': chunk}]}) + '\n'
+
+def read_chunks(userID='7'):
+    async def collect():
+        return [chunk async for chunk, _ in segmentStore.read_user_chunks(*SESSION, userID)]
+    return asyncio.run(collect())
+
+def append(chunk, start, userID='7'):
+    return segmentStore.write_chunk(segmentStore.lock_path(*SESSION), segmentStore.session_dir(*SESSION),
+                                    segmentStore.user_path(*SESSION, userID), chunk, record(chunk, start))
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    segmentStore.recorded_chunks.clear()
+    os.makedirs(segmentStore.session_dir(*SESSION))
+    yield segmentStore.session_dir(*SESSION)
+    segmentStore.recorded_chunks.clear()
+
+def write_log(lines, userID='7'):
+    with open(segmentStore.user_path(*SESSION, userID), 'w') as file:
+        file.write(''.join(lines))
+
+def test_torn_tail_is_skipped():
+    write_log([record('a', 0), record('b', 5), record('c', 9)[:20]])
+    assert read_chunks() == ['a', 'b']
+
+def test_append_after_torn_tail():
+    write_log([record('a', 0), record('b', 5)[:20]])
+    assert append('b', 5)
+    assert append('c', 9)
+    assert not append('c', 9)
+    assert read_chunks() == ['a', 'b', 'c']
+
+def test_chunks_read_in_time_order_without_repeats():
+    write_log([record('b', 5), record('a', 0), record('b', 5)])
+    assert read_chunks() == ['a', 'b']
+
+def write_legacy():
+    with open(segmentStore.legacy_transcript_path(*SESSION), 'w') as file:
+        json.dump({'7': [[{'start_seconds': 0, 'end_seconds': 1, 'text': 'old'}]]}, file)
+
+def migrate():
+    store = segmentStore.session_dir(*SESSION)
+    segmentStore.migrate_store(segmentStore.legacy_transcript_path(*SESSION), store, segmentStore.lock_path(*SESSION))
+    segmentStore.forget_store(store)
+
+def test_migration_keeps_chunks_recorded_since_the_upgrade(store):
+    write_legacy()
+    write_log([record('new', 5)])
+    migrate()
+    assert read_chunks() == ['legacy_0', 'new']
+    assert os.path.exists(segmentStore.legacy_transcript_path(*SESSION) + '.migrated')
+    assert sorted(os.listdir('transcripts')) == ['1_2_3', '1_2_3.json.migrated', '1_2_3.lock']
+
+def test_migration_rolls_forward_after_crash_before_conversion(store):
+    write_legacy()
+    write_log([record('new', 5)])
+    #Crashed right after the store was moved aside, then a chunk was recorded before the next run
+    os.replace(store, store + segmentStore.BACKUP_SUFFIX)
+    os.makedirs(store)
+    write_log([record('later', 9)])
+    migrate()
+    assert read_chunks() == ['legacy_0', 'new', 'later']
+
+def test_migration_rolls_forward_after_crash_before_swap(store):
+    write_legacy()
+    write_log([record('new', 5)])
+    #Crashed after the legacy file was renamed, with the rebuilt store (ending in a torn line) not yet in place
+    backup = store + segmentStore.BACKUP_SUFFIX
+    os.replace(store, backup)
+    scratch = store + segmentStore.MIGRATING_SUFFIX
+    segmentStore.convert_legacy_transcript(segmentStore.legacy_transcript_path(*SESSION), scratch)
+    segmentStore.append_logs(backup, scratch)
+    with open(os.path.join(scratch, '7.jsonl'), 'a') as file:
+        file.write(record('torn', 7)[:20])
+    os.replace(segmentStore.legacy_transcript_path(*SESSION), segmentStore.legacy_transcript_path(*SESSION) + '.migrated')
+    os.makedirs(store)
+    write_log([record('later', 9)])
+    migrate()
+    assert read_chunks() == ['legacy_0', 'new', 'later']
+    assert not os.path.exists(scratch) and not os.path.exists(backup)